@@ -0,0 +1,116 @@
+import os
+import struct
+import time
+from typing import *
+
+import numpy as np
+import soundfile
+from numpy.typing import NDArray
+
+from spans import *
+
+
+def _pcm16_data_chunk(path: str) -> Optional[Tuple[int, int, int]]:
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            return None
+
+        sample_rate = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack('<4sI', header)
+            if chunk_id == b'fmt ':
+                audio_format, num_channels, sample_rate, _, _, bits_per_sample = \
+                    struct.unpack('<HHIIHH', f.read(16))
+                if audio_format != 1 or num_channels != 1 or bits_per_sample != 16:
+                    return None
+                f.seek(chunk_size - 16 + (chunk_size % 2), 1)
+            elif chunk_id == b'data':
+                if sample_rate is None:
+                    return None
+                offset = f.tell()
+                return offset, min(chunk_size, os.path.getsize(path) - offset) // 2, sample_rate
+            else:
+                f.seek(chunk_size + (chunk_size % 2), 1)
+
+
+def read_pcm(path: str) -> Tuple[NDArray[np.int16], int]:
+    # mono 16-bit PCM is memory-mapped so that only the pages that are actually touched get read from disk
+    chunk = _pcm16_data_chunk(path)
+    if chunk is None:
+        pcm, sample_rate = soundfile.read(path, dtype='int16')
+        assert pcm.ndim == 1
+        return pcm, sample_rate
+
+    offset, num_samples, sample_rate = chunk
+    if num_samples == 0:
+        return np.zeros(0, dtype=np.int16), sample_rate
+
+    return np.memmap(path, dtype='<i2', mode='r', offset=offset, shape=(num_samples,)), sample_rate
+
+
+def frames(pcm: NDArray[np.int16], frame_length: int, pad: bool = False) -> Iterator[NDArray[np.int16]]:
+    num_frames = len(pcm) // frame_length
+    yield from pcm[:(num_frames * frame_length)].reshape((num_frames, frame_length))
+
+    remainder = len(pcm) - num_frames * frame_length
+    if pad and remainder > 0:
+        frame = np.zeros(frame_length, dtype=np.int16)
+        frame[:remainder] = pcm[-remainder:]
+        yield frame
+
+
+class PacedStream(object):
+    def __init__(self, pcm: NDArray[np.int16], sample_rate: int, chunk_ms: int, speed: float = 1.) -> None:
+        self._pcm = pcm
+        self._sample_rate = sample_rate
+        self._chunk_length = max(1, (sample_rate * chunk_ms) // 1000)
+        self._speed = speed
+        self._chunks = self._generate()
+        self._buffer = b''
+
+        self.end_sec = None
+        self.closed = False
+
+    def _generate(self) -> Iterator[bytes]:
+        start_sec = time.perf_counter()
+        for i in range(0, len(self._pcm), self._chunk_length):
+            if self._speed > 0:
+                delay_sec = start_sec + (i / self._sample_rate / self._speed) - time.perf_counter()
+                if delay_sec > 0:
+                    with span('sleep.pacing'):
+                        time.sleep(delay_sec)
+            yield self._pcm[i:(i + self._chunk_length)].tobytes()
+        self.end_sec = time.perf_counter()
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._chunks
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data = self._buffer + b''.join(self._chunks)
+            self._buffer = b''
+            return data
+
+        if len(self._buffer) == 0:
+            self._buffer = next(self._chunks, b'')
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self) -> None:
+        # `ibm_watson` closes its audio source once it has read it to the end, and only then tells the service that the
+        # audio is over
+        self._chunks = iter(())
+        self._buffer = b''
+        self.closed = True
+
+
+__all__ = [
+    'PacedStream',
+    'frames',
+    'read_pcm',
+]
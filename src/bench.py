@@ -1,18 +1,274 @@
+import json
 import logging as log
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from argparse import ArgumentParser
 from sys import argv
+from typing import *
 
+import numpy as np
+from numpy.typing import NDArray
+
+from cache import *
 from engine import *
+from journal import *
+from labels import *
+from metrics import *
+from perf import *
 from mix import *
+from results import *
+from spans import *
 
 log.basicConfig(format='', level=log.INFO)
 
+PIPELINED_ENGINES = (Engines.IBM_WATSON.value, Engines.MICROSOFT_LUIS.value)
+
+
+def format_accuracy(summary: Dict[str, Any], precision: int = 2) -> str:
+    # there is no accuracy when a shard or a condition has no utterances
+    return '-' if summary['accuracy'] is None else f"{summary['accuracy']:.{precision}f}"
+
+
+def format_results(results: Sequence[UtteranceResult], summary: Dict[str, Any]) -> List[str]:
+    lines = [f"{summary['num_utterances']} {summary['num_errors']} {format_accuracy(summary)}", format_summary(summary)]
+    if any(x.nlu_sec is not None for x in results):
+        lines.append(format_stage_summary(summary))
+    if any(x.finalized_sec is not None for x in results):
+        lines.append(format_endpoint_summary(summarize_endpoint(results, speech_end_sec=speech_end_sec)))
+
+    return lines
+
+
+def create_engine(
+        args: Any,
+        name: str,
+        label_index: LabelIndex,
+        slot_normalizer: SlotNormalizer) -> Tuple[Engine, Optional[CacheStore]]:
+    engine_params = dict()
+    for k, v in vars(args).items():
+        if k.startswith(name.lower()):
+            engine_params[k.replace(f'{name.lower()}_', '')] = v
+    # recordings of a streamed run are mixed again, with the noise bank of this run
+    if name == Engines.REPLAY.value:
+        engine_params['noise_cache_folder'] = args.noise_cache_dir
+
+    # the engine's SDK is imported as it is created, so this is where a run pays for it
+    start_sec = time.perf_counter()
+    start_rss_mb = rss_mb()
+    with span('client'):
+        engine = Engine.create(x=Engines(name), log=log, **engine_params)
+    init_sec = time.perf_counter() - start_sec
+    init_rss_mb = rss_mb() - start_rss_mb
+    engine.set_rate_limit(requests_per_sec=args.requests_per_sec, burst=args.burst)
+    engine.set_scoring(label_index, slot_normalizer)
+    if name != Engines.PICOVOICE_RHINO.value:
+        engine.set_streaming(chunk_ms=args.streaming_chunk_ms, speed=args.streaming_speed)
+    if name in PIPELINED_ENGINES:
+        engine.set_pipeline(
+            stt_workers=args.stt_workers,
+            nlu_workers=args.nlu_workers,
+            queue_size=args.pipeline_queue_size)
+        engine.set_stage_rate_limits(
+            stt_requests_per_sec=args.stt_requests_per_sec,
+            nlu_requests_per_sec=args.nlu_requests_per_sec,
+            burst=args.burst)
+    log.info(f'Initialized `{str(engine)}` engine in {init_sec:.2f} s (RSS +{init_rss_mb:.1f} MB)')
+
+    cache = None
+    if engine.is_cacheable and not args.no_cache:
+        with span('cache'):
+            cache = CacheStore(os.path.join(args.cache_dir, f'{str(engine).lower()}.db'))
+        engine.set_cache(cache)
+        if args.cache_invalidate is not None:
+            log.info(f'Invalidated {cache.invalidate(args.cache_invalidate)} cached results of `{str(engine)}`')
+        log.info(f'Loaded {len(cache)} cached results of `{str(engine)}` from `{cache.path}`')
+
+    return engine, cache
+
+
+def condition_input(
+        args: Any,
+        noise: str,
+        snr_db: int) -> Tuple[str, Optional[Callable[[str], NDArray[np.int16]]]]:
+    # streamed runs mix each utterance as it is loaded rather than reading the mixed WAVs
+    if args.stream:
+        folder = os.path.join(os.path.dirname(__file__), '../data/speech/clean')
+        loader = partial(noisy_pcm, noise=noise, snr_db=snr_db, seed=args.seed, cache_folder=args.noise_cache_dir)
+        return folder, loader
+    else:
+        return os.path.join(os.path.dirname(__file__), f'../data/speech/{noise}_{snr_db}db'), None
+
+
+def bench_engine(
+        args: Any,
+        engine: Engine,
+        cache: Optional[CacheStore],
+        noises: Sequence[str],
+        snrs_db: Sequence[int],
+        journal: Optional[RunJournal],
+        sink: Optional[ResultsSink],
+        label_index: LabelIndex,
+        prefix: str = '') -> List[Tuple[str, str, int, Dict[str, Any]]]:
+    rows = list()
+    for noise in noises:
+        for snr_db in snrs_db:
+            folder, loader = condition_input(args, noise, snr_db)
+            if loader is None and cache is not None and args.cache_import_legacy:
+                log.info(f'{prefix}Imported {engine.import_legacy_cache(folder)} legacy cached results')
+            if args.perf:
+                profile = profile_rhino(engine, folder=folder, repeat=args.perf_repeat, loader=loader)
+                log.info(f'{noise} {snr_db} dB:\n{format_profile(profile)}')
+                continue
+
+            names = shard(Engine.utterance_names(folder), index=args.shard_index, count=args.num_shards)
+            num_names = len(names)
+            if args.adaptive_ci_width is not None:
+                names = label_index.stratified_order(names, seed=args.seed)
+            completed = dict()
+            if journal is not None:
+                completed = {k: v for k, v in journal.completed(str(engine), noise, snr_db).items() if k in names}
+                names = [x for x in names if x not in completed]
+
+            def on_result(result: UtteranceResult) -> None:
+                with span('record'):
+                    if journal is not None:
+                        journal.record(str(engine), noise, snr_db, result)
+                    if sink is not None:
+                        sink.write(
+                            str(engine),
+                            noise,
+                            snr_db,
+                            result,
+                            label=label_index.label(result.name),
+                            source=engine.source)
+
+            start_sec = time.perf_counter()
+            if args.adaptive_ci_width is None:
+                results = engine.process_utterances(
+                    folder=folder,
+                    retry_limit=args.retry_limit,
+                    num_workers=args.workers,
+                    loader=loader,
+                    names=names,
+                    on_result=on_result)
+            else:
+                results = engine.process_utterances_adaptive(
+                    folder=folder,
+                    names=names,
+                    target_ci_width=args.adaptive_ci_width,
+                    confidence=args.adaptive_confidence,
+                    min_utterances=args.adaptive_min_utterances,
+                    batch_size=args.adaptive_batch_size,
+                    retry_limit=args.retry_limit,
+                    num_workers=args.workers,
+                    loader=loader,
+                    completed=list(completed.values()),
+                    on_result=on_result)
+            elapsed_sec = time.perf_counter() - start_sec
+
+            # throughput is not meaningful across sessions, so it is only reported for runs that did not resume
+            results = sorted(list(completed.values()) + results, key=lambda x: x.name)
+            summary = summarize(results, elapsed_sec=elapsed_sec if len(completed) == 0 else None)
+            rows.append((str(engine), noise, snr_db, summary))
+
+            # engines run concurrently in matrix mode, so each block is logged at once to keep its lines together
+            lines = [f'{prefix}{noise} {snr_db} dB:']
+            if len(completed) > 0:
+                lines.append(f'Resumed with {len(completed)} utterances completed and {len(names)} remaining')
+            if args.adaptive_ci_width is not None:
+                num_correct = sum(not x.is_error for x in results)
+                lower, upper = wilson_interval(num_correct, len(results), confidence=args.adaptive_confidence)
+                # utterances whose results are cached would not have cost a request
+                evaluated = set(x.name for x in results)
+                num_calls_saved = engine.num_service_calls(folder, [x for x in names if x not in evaluated], loader)
+                lines.append(
+                    f'Evaluated {len(results)} of {num_names} utterances, accuracy {args.adaptive_confidence:.0%} CI '
+                    f'[{lower:.3f}, {upper:.3f}], {num_calls_saved} calls saved')
+            log.info('\n'.join(lines + format_results(results, summary)))
+
+    return rows
+
+
+def sweep_rhino(
+        args: Any,
+        noises: Sequence[str],
+        snrs_db: Sequence[int],
+        sink: Optional[ResultsSink],
+        label_index: LabelIndex,
+        slot_normalizer: SlotNormalizer) -> List[Tuple[str, str, int, Dict[str, Any]]]:
+    sweep = RhinoSweep(
+        access_key=args.picovoice_rhino_access_key,
+        sensitivities=args.sweep_sensitivities,
+        processes=args.picovoice_rhino_processes,
+        pad_final_frame=args.picovoice_rhino_pad_final_frame,
+        log=log)
+    sweep.set_scoring(label_index, slot_normalizer)
+
+    rows = list()
+    for noise in noises:
+        for snr_db in snrs_db:
+            folder, loader = condition_input(args, noise, snr_db)
+            names = shard(Engine.utterance_names(folder), index=args.shard_index, count=args.num_shards)
+
+            start_sec = time.perf_counter()
+            results = sweep.process_utterances(folder, names=names, loader=loader)
+            elapsed_sec = time.perf_counter() - start_sec
+
+            lines = [f'{noise} {snr_db} dB ({len(results)} sensitivities in {elapsed_sec:.1f} sec):']
+            for sensitivity, x in results.items():
+                # each sensitivity is reported as an engine of its own, which keeps them apart in the results
+                engine = f'{Engines.PICOVOICE_RHINO.value}@{sensitivity:g}'
+                if sink is not None:
+                    for result in x:
+                        sink.write(
+                            engine,
+                            noise,
+                            snr_db,
+                            result,
+                            label=label_index.label(result.name),
+                            source=Engines.PICOVOICE_RHINO.value)
+                summary = summarize(x, elapsed_sec=None)
+                rows.append((engine, noise, snr_db, summary))
+                lines.append(f"sensitivity {sensitivity:g}: {summary['num_errors']} errors, accuracy "
+                             f"{format_accuracy(summary, precision=3)}")
+            log.info('\n'.join(lines))
+
+    sweep.delete()
+
+    return rows
+
+
+def save_profile(
+        args: Any,
+        spans: Spans,
+        engines: Sequence[str],
+        noises: Sequence[str],
+        snrs_db: Sequence[int]) -> None:
+    report = dict(engines=list(engines), noises=list(noises), snrs_db=list(snrs_db), **spans.report())
+    report['peak_rss_mb'] = peak_rss_mb()
+
+    stats = spans.cprofile_stats()
+    if stats is not None:
+        report['cprofile_path'] = os.path.splitext(args.profile_output)[0] + '.pstats'
+        stats.dump_stats(report['cprofile_path'])
+
+    with open(args.profile_output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    disable_spans()
+    log.info(f'{format_spans(report)}\nSaved profile to `{args.profile_output}`')
+
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument('--engine', choices=[x.value for x in Engines], required=True)
-    parser.add_argument('--noise', required=True, choices=['cafe', 'kitchen'])
+    parser.add_argument('--engine', choices=[x.value for x in Engines], default=None)
+    parser.add_argument('--engines', nargs='+', choices=[x.value for x in Engines], default=None)
+    parser.add_argument('--noise', default=None)
+    parser.add_argument('--noises', nargs='+', default=None)
+    parser.add_argument('--amazon_lex_max_connections', type=int, default=10)
     parser.add_argument('--google_dialogflow_credential_path', required=(Engines.GOOGLE_DIALOGFLOW.value in argv))
     parser.add_argument('--google_dialogflow_project_id', required=(Engines.GOOGLE_DIALOGFLOW.value in argv))
     parser.add_argument('--ibm_watson_model_id', required=(Engines.IBM_WATSON.value in argv))
@@ -21,38 +277,199 @@ def main():
     parser.add_argument('--ibm_watson_stt_url', required=(Engines.IBM_WATSON.value in argv))
     parser.add_argument('--ibm_watson_nlu_apikey', required=(Engines.IBM_WATSON.value in argv))
     parser.add_argument('--ibm_watson_nlu_url', required=(Engines.IBM_WATSON.value in argv))
+    parser.add_argument('--ibm_watson_max_connections', type=int, default=10)
     parser.add_argument('--microsoft_luis_luis_prediction_key', required=(Engines.MICROSOFT_LUIS.value in argv))
     parser.add_argument('--microsoft_luis_luis_endpoint_url', required=(Engines.MICROSOFT_LUIS.value in argv))
     parser.add_argument('--microsoft_luis_luis_app_id', required=(Engines.MICROSOFT_LUIS.value in argv))
     parser.add_argument('--microsoft_luis_speech_key', required=(Engines.MICROSOFT_LUIS.value in argv))
     parser.add_argument('--microsoft_luis_speech_endpoint_id', required=(Engines.MICROSOFT_LUIS.value in argv))
     parser.add_argument('--picovoice_rhino_access_key', required=(Engines.PICOVOICE_RHINO.value in argv))
+    parser.add_argument('--picovoice_rhino_processes', type=int, default=1)
+    parser.add_argument('--picovoice_rhino_pad_final_frame', action='store_true')
+    parser.add_argument('--picovoice_rhino_sensitivity', type=float, default=.75)
+    parser.add_argument('--sweep_sensitivities', nargs='+', type=float, default=None)
+    parser.add_argument(
+        '--replay_source',
+        choices=[x.value for x in Engines if x is not Engines.REPLAY],
+        required=(Engines.REPLAY.value in argv))
+    parser.add_argument('--replay_folders', nargs='+', default=None)
+    parser.add_argument('--replay_results', nargs='+', default=None)
+    parser.add_argument('--replay_latency_scale', type=float, default=1.)
+    parser.add_argument('--replay_error_rate', type=float, default=0.)
+    parser.add_argument('--replay_throttle_rate', type=float, default=0.)
+    parser.add_argument('--replay_seed', type=int, default=0)
     parser.add_argument('--snrs_db', nargs='+', default=list(range(24, 3, -3)))
-    parser.add_argument('--sleep_sec', type=float, default=0.)
+    parser.add_argument('--requests_per_sec', type=float, default=None)
+    parser.add_argument('--burst', type=float, default=None)
+    parser.add_argument('--retry_limit', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--stt_workers', type=int, default=None)
+    parser.add_argument('--nlu_workers', type=int, default=None)
+    parser.add_argument('--pipeline_queue_size', type=int, default=None)
+    parser.add_argument('--stt_requests_per_sec', type=float, default=None)
+    parser.add_argument('--nlu_requests_per_sec', type=float, default=None)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mix_processes', type=int, default=1)
+    parser.add_argument('--cache_dir', default=os.path.join(os.path.dirname(__file__), '../data/cache'))
+    parser.add_argument('--no_cache', action='store_true')
+    parser.add_argument('--cache_invalidate', nargs='?', const='*', default=None)
+    parser.add_argument('--cache_import_legacy', action='store_true')
+    parser.add_argument('--cache_export', default=None)
+    parser.add_argument('--slot_normalization', default=DEFAULT_NORMALIZATION_PATH)
+    parser.add_argument('--streaming_chunk_ms', type=int, default=None)
+    parser.add_argument('--streaming_speed', type=float, default=1.)
+    parser.add_argument('--journal', default=None)
+    parser.add_argument('--results', default=None)
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--num_shards', type=int, default=1)
+    parser.add_argument('--reconcile', nargs='+', default=None)
+    parser.add_argument('--adaptive_ci_width', type=float, default=None)
+    parser.add_argument('--adaptive_confidence', type=float, default=.95)
+    parser.add_argument('--adaptive_min_utterances', type=int, default=64)
+    parser.add_argument('--adaptive_batch_size', type=int, default=64)
+    parser.add_argument('--perf', action='store_true')
+    parser.add_argument('--perf_repeat', type=int, default=1)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('--profile_cprofile', action='store_true')
+    parser.add_argument('--profile_tracemalloc', action='store_true')
+    parser.add_argument('--profile_output', default=None)
     args = parser.parse_args()
 
-    engine = Engines(args.engine)
+    # starting the interpreter, importing the modules and parsing the arguments, which every invocation pays
+    start_sec = startup_sec()
+    if start_sec is not None:
+        log.info(f'Started in {start_sec:.2f} s (RSS {rss_mb():.1f} MB)')
 
-    engine_params = dict()
-    for k, v in vars(args).items():
-        if k.startswith(engine.value.lower()):
-            engine_params[k.replace(f'{engine.value.lower()}_', '')] = v
+    if (args.engine is None) == (args.engines is None):
+        parser.error('exactly one of --engine and --engines is required')
+    if (args.noise is None) == (args.noises is None):
+        parser.error('exactly one of --noise and --noises is required')
+    engine_names = list(dict.fromkeys([args.engine] if args.engines is None else args.engines))
+    noises = list(dict.fromkeys([args.noise] if args.noises is None else args.noises))
+    snrs_db = sorted([int(x) for x in args.snrs_db])
+    for noise in noises:
+        try:
+            check_condition(noise)
+        except ValueError as e:
+            parser.error(str(e))
 
-    engine = Engine.create(x=engine, log=log, **engine_params)
-    log.info(f'Initialized `{str(engine)}` engine')
+    if args.reconcile is not None:
+        manifest, completed = reconcile(args.reconcile)
+        if manifest['engines'] != engine_names or manifest['noises'] != noises:
+            parser.error(f"journals are for {manifest['engines']} with {manifest['noises']} noise")
+        num_names = len(Engine.utterance_names(os.path.join(os.path.dirname(__file__), '../data/speech/clean')))
+        rows = list()
+        for (engine, noise, snr_db), results in completed.items():
+            summary = summarize(results, elapsed_sec=None)
+            rows.append((engine, noise, snr_db, summary))
+            lines = [f'{engine} {noise} {snr_db} dB ({num_names - len(results)} utterances missing):']
+            log.info('\n'.join(lines + format_results(results, summary)))
+        log.info(format_table(rows))
+        return
 
-    noise = args.noise
-    snrs_db = sorted([int(x) for x in args.snrs_db])
-    sleep_sec = args.sleep_sec
+    if args.perf and engine_names != [Engines.PICOVOICE_RHINO.value]:
+        parser.error(f'--perf is only supported for `{Engines.PICOVOICE_RHINO.value}` on its own')
+    if args.perf and args.picovoice_rhino_processes > 1:
+        parser.error('--perf profiles a single instance and is not supported with --picovoice_rhino_processes')
+    if args.streaming_chunk_ms is not None and engine_names == [Engines.PICOVOICE_RHINO.value]:
+        parser.error(f'`{Engines.PICOVOICE_RHINO.value}` always processes audio frame by frame')
+    pipeline_args = (
+        args.stt_workers,
+        args.nlu_workers,
+        args.pipeline_queue_size,
+        args.stt_requests_per_sec,
+        args.nlu_requests_per_sec)
+    if not any(x in PIPELINED_ENGINES for x in engine_names) and any(x is not None for x in pipeline_args):
+        parser.error(f'pipeline options are only supported for `{Engines.IBM_WATSON.value}` and '
+                     f'`{Engines.MICROSOFT_LUIS.value}`')
+    if (args.journal is not None or args.results is not None) and args.perf:
+        parser.error('--journal and --results are not supported with --perf')
+    if not (0 <= args.shard_index < args.num_shards):
+        parser.error('--shard_index must be in [0, --num_shards)')
+    if args.cache_export is not None and len(engine_names) > 1:
+        parser.error('--cache_export is only supported for a single engine')
+    # the per-stage breakdown goes next to the results unless it is given a path of its own
+    if args.profile_cprofile or args.profile_tracemalloc:
+        args.profile = True
+    if args.profile and args.profile_output is None:
+        if args.results is None:
+            parser.error('--profile requires --results or --profile_output')
+        args.profile_output = f'{os.path.splitext(args.results)[0]}.profile.json'
+    if args.sweep_sensitivities is not None:
+        if engine_names != [Engines.PICOVOICE_RHINO.value]:
+            parser.error(f'--sweep_sensitivities is only supported for `{Engines.PICOVOICE_RHINO.value}` on its own')
+        if args.journal is not None or args.perf or args.adaptive_ci_width is not None:
+            parser.error('--sweep_sensitivities is not supported with --journal, --perf or --adaptive_ci_width')
+
+    spans = enable_spans(cprofile=args.profile_cprofile, trace_allocations=args.profile_tracemalloc) \
+        if args.profile else None
+
+    # the labels are indexed once per run, and the index is kept next to the engine caches so that later runs skip
+    # parsing `label.json` unless it changed
+    with span('labels'):
+        label_index = LabelIndex.load(cache_path=None if args.no_cache else os.path.join(args.cache_dir, 'labels.npz'))
+        slot_normalizer = SlotNormalizer.load(args.slot_normalization)
+
+    # the noise bank is kept with the other caches, or under `--no_cache` in a directory that is removed at exit
+    noise_cache = tempfile.TemporaryDirectory() if args.no_cache else None
+    args.noise_cache_dir = args.cache_dir if noise_cache is None else noise_cache.name
+
+    journal = None
+    if args.journal is not None:
+        manifest = dict(
+            engines=engine_names,
+            noises=noises,
+            seed=args.seed,
+            stream=args.stream,
+            streaming_chunk_ms=args.streaming_chunk_ms,
+            streaming_speed=args.streaming_speed,
+            shard_index=args.shard_index,
+            num_shards=args.num_shards)
+        journal = RunJournal(args.journal, manifest=manifest)
+
+    sink = None if args.results is None else ResultsSink(args.results, seed=args.seed)
+
+    if not args.stream:
+        with span('mix.run'):
+            run_all(
+                noises,
+                snrs_ds=snrs_db,
+                seed=args.seed,
+                processes=args.mix_processes,
+                cache_folder=args.noise_cache_dir)
+
+    if args.sweep_sensitivities is not None:
+        log.info(format_table(sweep_rhino(args, noises, snrs_db, sink, label_index, slot_normalizer)))
+        if sink is not None:
+            sink.close()
+        if spans is not None:
+            save_profile(args, spans, engine_names, noises, snrs_db)
+        return
+
+    engines = [create_engine(args, x, label_index, slot_normalizer) for x in engine_names]
+
+    # each engine has its own quota, so the engines run side by side and each one works through the grid in order
+    prefix = (lambda x: f'{str(x)} ') if len(engines) > 1 else (lambda x: '')
+    with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+        futures = [
+            executor.submit(
+                bench_engine, args, engine, cache, noises, snrs_db, journal, sink, label_index, prefix=prefix(engine))
+            for engine, cache in engines]
+        rows = [row for future in futures for row in future.result()]
+    if len(engines) > 1 or len(noises) > 1:
+        log.info(format_table(rows))
 
-    run(noise=noise, snrs_ds=snrs_db)
+    cache = engines[0][1]
+    if cache is not None and args.cache_export is not None:
+        log.info(f'Exported {cache.export(args.cache_export)} cached results to `{args.cache_export}`')
 
-    for snr_db in snrs_db:
-        log.info(f'{noise} {snr_db} dB:')
-        num_examples, num_errors = engine.process(
-            folder=os.path.join(os.path.dirname(__file__), f'../data/speech/{noise}_{snr_db}db'),
-            sleep_sec=sleep_sec)
-        log.info(f"{num_examples} {num_errors} {(num_examples - num_errors) / num_examples:.2f}")
+    if journal is not None:
+        journal.close()
+    if sink is not None:
+        sink.close()
+    if spans is not None:
+        save_profile(args, spans, engine_names, noises, snrs_db)
 
 
 if __name__ == "__main__":
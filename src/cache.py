@@ -0,0 +1,80 @@
+import fnmatch
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import *
+
+
+class CacheStore(object):
+    def __init__(self, path: str) -> None:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, name TEXT, value TEXT NOT NULL, timestamp REAL)')
+
+        self._index = dict()
+        for key, name, value in self._connection.execute('SELECT key, name, value FROM cache'):
+            self._index[key] = (name, json.loads(value))
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        x = self._index.get(key)
+        return None if x is None else x[1]
+
+    def put(self, key: str, name: str, value: Dict[str, Any]) -> None:
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO cache (key, name, value, timestamp) VALUES (?, ?, ?, ?)',
+                (key, name, json.dumps(value), time.time()))
+            self._index[key] = (name, value)
+
+    def invalidate(self, name_pattern: Optional[str] = None) -> int:
+        with self._lock:
+            if name_pattern is None:
+                keys = list(self._index.keys())
+            else:
+                keys = [k for k, (name, _) in self._index.items() if fnmatch.fnmatch(name, name_pattern)]
+
+            self._connection.execute('BEGIN')
+            self._connection.executemany('DELETE FROM cache WHERE key = ?', [(k,) for k in keys])
+            self._connection.execute('COMMIT')
+            for key in keys:
+                del self._index[key]
+
+        return len(keys)
+
+    def export(self, path: str) -> int:
+        with self._lock:
+            rows = self._connection.execute('SELECT key, name, value, timestamp FROM cache ORDER BY name').fetchall()
+
+        with open(path, 'w') as f:
+            for key, name, value, timestamp in rows:
+                f.write(json.dumps(dict(key=key, name=name, value=json.loads(value), timestamp=timestamp)) + '\n')
+
+        return len(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+
+__all__ = [
+    'CacheStore',
+]
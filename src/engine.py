@@ -1,22 +1,32 @@
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
+import queue
+import random
+import threading
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from enum import Enum
 from logging import Logger
+from multiprocessing.util import Finalize
 from typing import *
 
-import azure.cognitiveservices.speech as speechsdk
-import boto3
-import pvrhino
-import requests
+import numpy as np
 import soundfile
-from azure.cognitiveservices.language.luis.runtime import LUISRuntimeClient
-from google.cloud import dialogflow
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_watson import NaturalLanguageUnderstandingV1, SpeechToTextV1
-from ibm_watson.natural_language_understanding_v1 import EntitiesOptions, Features
-from msrest.authentication import CognitiveServicesCredentials
+from numpy.typing import NDArray
+
+from audio import *
+from cache import *
+from labels import *
+from metrics import *
+from mix import *
+from ratelimit import *
+from results import *
+from spans import *
 
 
 class Engines(Enum):
@@ -25,177 +35,828 @@ class Engines(Enum):
     IBM_WATSON = 'IBM_WATSON'
     MICROSOFT_LUIS = 'MICROSOFT_LUIS'
     PICOVOICE_RHINO = 'PICOVOICE_RHINO'
+    REPLAY = 'REPLAY'
+
+
+@dataclass
+class UtteranceResult:
+    name: str
+    inference: Optional[Dict[str, Any]] = None
+    is_error: bool = False
+    is_cached: bool = False
+    audio_sec: float = 0.
+    latency_sec: Optional[float] = None
+    ttfb_sec: Optional[float] = None
+    total_sec: float = 0.
+    num_attempts: int = 0
+    num_retries: int = 0
+    finalized_sec: Optional[float] = None
+    eos_latency_sec: Optional[float] = None
+    stt_sec: Optional[float] = None
+    nlu_sec: Optional[float] = None
+    is_transcript_cached: bool = False
+    failure: Optional[str] = None
+    slot_errors: Optional[Dict[str, str]] = None
+
+
+@functools.lru_cache(maxsize=None)
+def _default_scoring() -> Tuple[LabelIndex, SlotNormalizer]:
+    return LabelIndex.load(), SlotNormalizer.load()
+
+
+def _score_results(
+        results: Sequence[UtteranceResult],
+        label_index: LabelIndex,
+        slot_normalizer: SlotNormalizer,
+        engine: str) -> None:
+    # `engine` picks the slot normalization rules that apply to the inferences
+    with span('score'):
+        score = label_index.score(
+            [x.name for x in results],
+            [x.inference for x in results],
+            normalize=functools.partial(slot_normalizer.normalize, engine))
+
+        failures = score.failures()
+        for i, result in enumerate(results):
+            result.is_error = bool(score.is_error[i])
+            result.failure = failures[i]
+            result.slot_errors = score.slot_errors(i)
 
 
 class Engine(object):
+    # engines register themselves with `Engine.register`. each one imports its SDK only when it is constructed, so a
+    # run pays the import time and memory of the engines it uses and only those need to be installed
+    _REGISTRY = dict()
+
+    _CACHE_EXTENSION = None
+    _CONTEXT_PATHS = ()
+
     def __init__(self, log: Optional[Logger] = None) -> None:
         self._log = log
+        self._rate_limiter = None
+        self._backoff = Backoff()
+        self._cache = None
+        self._config_digest = None
+        self._timing = threading.local()
+        self._stream_chunk_ms = None
+        self._stream_speed = 1.
+        self._label_index = None
+        self._slot_normalizer = None
+
+    def set_rate_limit(self, requests_per_sec: Optional[float], burst: Optional[float] = None) -> None:
+        self._rate_limiter = TokenBucket(rate=requests_per_sec, capacity=burst) if requests_per_sec else None
+
+    def set_cache(self, cache: Optional[CacheStore]) -> None:
+        self._cache = cache
+
+    def set_scoring(self, label_index: LabelIndex, slot_normalizer: SlotNormalizer) -> None:
+        self._label_index = label_index
+        self._slot_normalizer = slot_normalizer
+
+    def set_streaming(self, chunk_ms: Optional[int], speed: float = 1.) -> None:
+        self._stream_chunk_ms = chunk_ms
+        self._stream_speed = speed
+        self._config_digest = None
+
+    @property
+    def is_streaming(self) -> bool:
+        return self._stream_chunk_ms is not None
+
+    @property
+    def is_cacheable(self) -> bool:
+        return self._CACHE_EXTENSION is not None
+
+    def _cache_config(self) -> Dict[str, Any]:
+        return dict()
+
+    @staticmethod
+    def _file_digest(path: str) -> str:
+        with open(os.path.join(os.path.dirname(__file__), '..', path), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _digest(self, config: Dict[str, Any], context_paths: Sequence[str]) -> bytes:
+        config = dict(config, context={x: self._file_digest(x) for x in context_paths})
+        if self.is_streaming:
+            config['streaming'] = True
+
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).digest()
+
+    @staticmethod
+    def _pcm_key(config_digest: bytes, pcm: NDArray[np.int16]) -> str:
+        digest = hashlib.sha256(config_digest)
+        digest.update(np.ascontiguousarray(pcm, dtype='<i2').tobytes())
+
+        return digest.hexdigest()
+
+    def cache_key(self, pcm: NDArray[np.int16]) -> str:
+        if self._config_digest is None:
+            self._config_digest = self._digest(dict(engine=str(self), **self._cache_config()), self._CONTEXT_PATHS)
+
+        return self._pcm_key(self._config_digest, pcm)
+
+    def import_legacy_cache(self, folder: str) -> int:
+        num_imported = 0
+        for x in sorted(os.listdir(folder)):
+            if x.endswith(self._CACHE_EXTENSION):
+                with span('cache'):
+                    wav_path = os.path.join(folder, x.replace(self._CACHE_EXTENSION, '.wav'))
+                    if not os.path.exists(wav_path):
+                        continue
+                    with span('decode'):
+                        pcm = soundfile.read(wav_path, dtype='int16')[0]
+                    key = self.cache_key(pcm)
+                    with open(os.path.join(folder, x)) as f:
+                        self._cache.put(key, os.path.basename(wav_path), json.load(f))
+                num_imported += 1
+
+        return num_imported
 
     def process_file(self, path: str) -> Optional[Dict[str, str]]:
         raise NotImplementedError()
 
-    def process(self, folder: str, sleep_sec: float = 2., retry_limit: int = 32) -> Tuple[int, int]:
-        with open(os.path.join(os.path.dirname(__file__), f'../data/label/label.json')) as f:
-            labels = json.load(f)
-
-        num_utterances = 0
-        num_errors = 0
-        for x in os.listdir(folder):
-            if x.endswith('.wav'):
-                num_utterances += 1
-
-                label = labels[x]
-
-                time.sleep(sleep_sec)
-
-                retry_count = 0
-                inference = None
-                while retry_count < retry_limit:
-                    try:
-                        inference = self.process_file(os.path.join(folder, x))
-                        break
-                    except Exception as e:
-                        if self._log is not None:
-                            self._log.warning(e)
-                        retry_count += 1
-                if retry_count == retry_limit:
-                    raise RuntimeError()
-
-                if inference is None:
-                    num_errors += 1
-                elif label["intent"] != inference["intent"]:
-                    num_errors += 1
-                else:
-                    for slot in label["slots"].keys():
-                        if slot not in inference["slots"]:
-                            num_errors += 1
-                            break
-                        if inference["slots"][slot].strip() != label["slots"][slot].strip():
-                            num_errors += 1
-                            break
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError()
+
+    def _stream_pcm(self, stream: PacedStream, name: str) -> Optional[Dict[str, str]]:
+        raise NotImplementedError()
+
+    def _process_paced(self, process: Callable[[PacedStream], Any], pcm: NDArray[np.int16]) -> Any:
+        stream = PacedStream(pcm, sample_rate=16000, chunk_ms=self._stream_chunk_ms, speed=self._stream_speed)
+
+        x = process(stream)
+
+        if stream.end_sec is not None:
+            self._record(eos_latency_sec=time.perf_counter() - stream.end_sec)
+
+        return x
+
+    def process_stream(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        return self._process_paced(lambda x: self._stream_pcm(x, name), pcm)
+
+    def _record(self, **kwargs: Any) -> None:
+        if getattr(self._timing, 'start', None) is not None:
+            self._timing.records.update(kwargs)
+
+    def _mark_first_byte(self) -> None:
+        start = getattr(self._timing, 'start', None)
+        if start is not None and self._timing.first_byte_sec is None:
+            self._timing.first_byte_sec = time.perf_counter() - start
+
+    def _retry(
+            self,
+            process: Callable[[], Any],
+            result: UtteranceResult,
+            retry_limit: int,
+            rate_limiter: Optional[TokenBucket],
+            stage: str = 'inference') -> Tuple[Any, float]:
+        for attempt in range(retry_limit):
+            if rate_limiter is not None:
+                with span('sleep.rate_limit'):
+                    rate_limiter.acquire()
+
+            result.num_attempts += 1
+            result.num_retries += int(attempt > 0)
+            self._timing.start = time.perf_counter()
+            self._timing.first_byte_sec = None
+            self._timing.records = dict()
+            try:
+                with span(stage):
+                    x = process()
+                elapsed_sec = time.perf_counter() - self._timing.start
+                for k, v in self._timing.records.items():
+                    setattr(result, k, v)
+                return x, elapsed_sec
+            except Exception as e:
+                kind = classify_error(e)
+                if self._log is not None:
+                    self._log.warning(f"{kind.value} error processing `{result.name}`: {e}")
+                if kind is ErrorKinds.FATAL:
+                    raise
+
+                delay_sec = self._backoff.delay(attempt)
+                if kind is ErrorKinds.THROTTLED and rate_limiter is not None:
+                    rate_limiter.pause(delay_sec)
+                with span('sleep.backoff'):
+                    time.sleep(delay_sec)
+
+        raise RuntimeError(f"Failed to process `{result.name}` after {retry_limit} attempts")
+
+    def _process_with_retry(
+            self,
+            process: Callable[[], Optional[Dict[str, str]]],
+            result: UtteranceResult,
+            retry_limit: int) -> Optional[Dict[str, str]]:
+        inference, result.latency_sec = self._retry(process, result, retry_limit, rate_limiter=self._rate_limiter)
+        result.ttfb_sec = self._timing.first_byte_sec
+
+        return inference
+
+    def score(self, results: Sequence[UtteranceResult]) -> None:
+        if self._label_index is None:
+            self._label_index, self._slot_normalizer = _default_scoring()
+
+        _score_results(results, self._label_index, self._slot_normalizer, self.source)
+
+    @property
+    def source(self) -> str:
+        # the engine whose inferences these are, whose slot normalization rules apply
+        return str(self)
+
+    def _load_utterance(
+            self,
+            path: str,
+            loader: Optional[Callable[[str], NDArray[np.int16]]]) -> Tuple[Optional[NDArray[np.int16]], float]:
+        if loader is not None:
+            pcm = loader(os.path.basename(path))
+            return pcm, len(pcm) / 16000
+
+        with span('decode'):
+            if self.is_streaming:
+                pcm, sample_rate = read_pcm(path)
+                return pcm, len(pcm) / sample_rate
+            elif self._cache is not None:
+                pcm, sample_rate = soundfile.read(path, dtype='int16')
+                return pcm, len(pcm) / sample_rate
+            else:
+                info = soundfile.info(path)
+                return None, info.frames / info.samplerate
+
+    def _process_utterance(
+            self,
+            folder: str,
+            name: str,
+            retry_limit: int,
+            loader: Optional[Callable[[str], NDArray[np.int16]]]) -> UtteranceResult:
+        start = time.perf_counter()
+        result = UtteranceResult(name=name)
+
+        path = os.path.join(folder, name)
+        pcm, result.audio_sec = self._load_utterance(path, loader)
+        if self.is_streaming:
+            process = lambda: self.process_stream(pcm, name)
+        elif loader is None:
+            process = lambda: self.process_file(path)
+        else:
+            process = lambda: self.process_pcm(pcm, name)
+
+        key = None
+        if self._cache is not None:
+            with span('cache'):
+                key = self.cache_key(pcm)
+                if key in self._cache:
+                    result.inference = self._cache.get(key)
+                    result.is_cached = True
+                    result.total_sec = time.perf_counter() - start
+                    return result
+
+        result.inference = self._process_with_retry(process, result=result, retry_limit=retry_limit)
+
+        if key is not None and result.inference is not None:
+            with span('cache'):
+                self._cache.put(key, name, result.inference)
+
+        result.total_sec = time.perf_counter() - start
 
-        return num_utterances, num_errors
+        return result
+
+    def _process_utterances(
+            self,
+            folder: str,
+            names: Sequence[str],
+            retry_limit: int,
+            num_workers: int,
+            loader: Optional[Callable[[str], NDArray[np.int16]]],
+            on_result: Optional[Callable[[UtteranceResult], None]] = None) -> List[UtteranceResult]:
+        def process_utterance(x: str) -> UtteranceResult:
+            result = self._process_utterance(folder, x, retry_limit=retry_limit, loader=loader)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        if num_workers > 1:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                return list(executor.map(process_utterance, names))
+        else:
+            return [process_utterance(x) for x in names]
+
+    def num_service_calls(
+            self,
+            folder: str,
+            names: Sequence[str],
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None) -> int:
+        # the requests that evaluating `names` would make, i.e. one for each utterance that is not cached
+        if self._cache is None:
+            return len(names)
+
+        return sum(self.cache_key(self._load_utterance(os.path.join(folder, x), loader)[0]) not in self._cache
+                   for x in names)
+
+    @staticmethod
+    def utterance_names(folder: str) -> List[str]:
+        return sorted(x for x in os.listdir(folder) if x.endswith('.wav'))
+
+    def process_utterances(
+            self,
+            folder: str,
+            retry_limit: int = 32,
+            num_workers: int = 1,
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None,
+            names: Optional[Sequence[str]] = None,
+            on_result: Optional[Callable[[UtteranceResult], None]] = None,
+            score_batch_size: int = 64) -> List[UtteranceResult]:
+        # with `on_result` the results are scored in batches of `score_batch_size` as they complete, so that the
+        # callback sees their final outcome while scoring stays vectorized. it sees each result at most a batch late,
+        # which is all that an interrupted run can lose. without it all of them are scored at once
+        pending = list()
+        lock = threading.Lock()
+
+        def flush(batch: List[UtteranceResult]) -> None:
+            self.score(batch)
+            for x in batch:
+                on_result(x)
+
+        def collect(result: UtteranceResult) -> None:
+            with lock:
+                pending.append(result)
+                if len(pending) < score_batch_size:
+                    return
+                batch = list(pending)
+                pending.clear()
+            flush(batch)
+
+        results = self._process_utterances(
+            folder,
+            self.utterance_names(folder) if names is None else names,
+            retry_limit=retry_limit,
+            num_workers=num_workers,
+            loader=loader,
+            on_result=None if on_result is None else collect)
+
+        if on_result is None:
+            self.score(results)
+        elif len(pending) > 0:
+            flush(pending)
+
+        return results
+
+    def process_utterances_adaptive(
+            self,
+            folder: str,
+            names: Sequence[str],
+            target_ci_width: float,
+            confidence: float = .95,
+            min_utterances: int = 64,
+            batch_size: int = 64,
+            retry_limit: int = 32,
+            num_workers: int = 1,
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None,
+            completed: Sequence[UtteranceResult] = (),
+            on_result: Optional[Callable[[UtteranceResult], None]] = None) -> List[UtteranceResult]:
+        # `names` are evaluated a batch at a time, in order, until the confidence interval of the accuracy over them
+        # and `completed` is at most `target_ci_width` wide. they should be in random order, e.g. from
+        # `LabelIndex.stratified_order`, so that the ones evaluated are a representative sample
+        results = list()
+        num_correct = sum(not x.is_error for x in completed)
+        for start in range(0, len(names), batch_size):
+            num_evaluated = len(completed) + len(results)
+            if num_evaluated >= min_utterances:
+                lower, upper = wilson_interval(num_correct, num_evaluated, confidence=confidence)
+                if (upper - lower) <= target_ci_width:
+                    break
+
+            batch = self.process_utterances(
+                folder,
+                retry_limit=retry_limit,
+                num_workers=num_workers,
+                loader=loader,
+                names=names[start:(start + batch_size)],
+                on_result=on_result)
+            results.extend(batch)
+            num_correct += sum(not x.is_error for x in batch)
+
+        return results
+
+    def process(
+            self,
+            folder: str,
+            retry_limit: int = 32,
+            num_workers: int = 1,
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None) -> Tuple[int, int]:
+        results = self.process_utterances(folder, retry_limit=retry_limit, num_workers=num_workers, loader=loader)
+
+        return len(results), sum(x.is_error for x in results)
 
     def __str__(self) -> str:
         raise NotImplementedError()
 
+    @classmethod
+    def register(cls, x: Engines) -> Callable[[Type['Engine']], Type['Engine']]:
+        def decorator(engine: Type['Engine']) -> Type['Engine']:
+            Engine._REGISTRY[x] = engine
+            return engine
+
+        return decorator
+
     @classmethod
     def create(cls, x: Engines, **kwargs: Any) -> 'Engine':
-        if x is Engines.AMAZON_LEX:
-            return AmazonLex(**kwargs)
-        elif x is Engines.GOOGLE_DIALOGFLOW:
-            return GoogleDialogflow(**kwargs)
-        elif x is Engines.IBM_WATSON:
-            return IBMWatson(**kwargs)
-        elif x is Engines.MICROSOFT_LUIS:
-            return MicrosoftLUIS(**kwargs)
-        elif x is Engines.PICOVOICE_RHINO:
-            return PicovoiceRhino(**kwargs)
-        else:
+        if x not in Engine._REGISTRY:
             raise ValueError(f"Cannot create `{cls.__name__}` of type `{x.value}`")
 
+        return Engine._REGISTRY[x](**kwargs)
+
 
+@Engine.register(Engines.AMAZON_LEX)
 class AmazonLex(Engine):
-    def __init__(self, log: Optional[Logger] = None) -> None:
+    _CACHE_EXTENSION = '.lex'
+    _CONTEXT_PATHS = ('data/amazonlex/barista_50.zip', 'data/amazonlex/barista_432.zip')
+
+    def __init__(self, max_connections: int = 10, log: Optional[Logger] = None) -> None:
         super(AmazonLex, self).__init__(log=log)
-        self._client = boto3.client('lex-runtime')
 
-    def process_file(self, path: str) -> Optional[Dict[str, str]]:
-        cache_path = path.replace('.wav', '.lex')
+        import boto3
+        from botocore.config import Config
 
-        if os.path.exists(cache_path):
-            with open(cache_path) as f:
-                return json.load(f)
+        # `boto3` clients are thread-safe and keep a pool of HTTP connections that is shared by all workers
+        self._client = boto3.client('lex-runtime', config=Config(max_pool_connections=max_connections))
 
+    def process_file(self, path: str) -> Optional[Dict[str, str]]:
         with open(path, 'rb') as f:
-            response = self._client.post_content(
-                botName='barista',
-                botAlias='$LATEST',
-                userId=str(uuid.uuid4()),
-                contentType='audio/l16; rate=16000; channels=1',
-                accept='text/plain; charset=utf-8',
-                inputStream=f
-            )
-
-        res = {
+            return self._post_content(f)
+
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        return self._post_content(pcm.tobytes())
+
+    def _stream_pcm(self, stream: PacedStream, name: str) -> Optional[Dict[str, str]]:
+        # `post_content` reads its input stream incrementally and sends it with chunked transfer encoding
+        return self._post_content(stream)
+
+    def _cache_config(self) -> Dict[str, Any]:
+        return dict(bot_name='barista', bot_alias='$LATEST')
+
+    def _post_content(self, input_stream: Union[bytes, BinaryIO, PacedStream]) -> Optional[Dict[str, str]]:
+        response = self._client.post_content(
+            botName='barista',
+            botAlias='$LATEST',
+            userId=str(uuid.uuid4()),
+            contentType='audio/l16; rate=16000; channels=1',
+            accept='text/plain; charset=utf-8',
+            inputStream=input_stream
+        )
+        self._mark_first_byte()
+
+        return {
             "intent": response['intentName'],
             "slots": {k: v for k, v in response['slots'].items() if v is not None},
             "transcript": response['inputTranscript']
         }
 
-        with open(cache_path, 'w') as f:
-            json.dump(res, f, indent=2)
-
-        return res
-
     def __str__(self) -> str:
         return Engines.AMAZON_LEX.value
 
 
+@Engine.register(Engines.GOOGLE_DIALOGFLOW)
 class GoogleDialogflow(Engine):
+    _CACHE_EXTENSION = '.dialogflow'
+    _CONTEXT_PATHS = ('data/dialogflow/barista_50.zip', 'data/dialogflow/barista_432.zip')
+
     def __init__(self, credential_path: str, project_id: str, log: Optional[Logger] = None) -> None:
         super(GoogleDialogflow, self).__init__(log=log)
 
+        from google.cloud import dialogflow
+
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credential_path
 
+        self._dialogflow = dialogflow
         self._project_id = project_id
 
+        # the client is thread-safe and multiplexes concurrent requests over a single gRPC channel
+        self._session_client = dialogflow.SessionsClient()
+
     def process_file(self, path: str) -> Optional[Dict[str, str]]:
-        cache_path = path.replace('.wav', '.dialogflow')
+        with open(path, 'rb') as f:
+            input_audio = f.read()
+
+        return self._detect_intent(session_id=os.path.basename(path)[0], input_audio=input_audio)
+
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        return self._detect_intent(session_id=name[0], input_audio=pcm.tobytes())
 
-        if os.path.exists(cache_path):
-            with open(cache_path) as f:
-                return json.load(f)
+    def _stream_pcm(self, stream: PacedStream, name: str) -> Optional[Dict[str, str]]:
+        session = self._session_client.session_path(self._project_id, name[0])
 
-        session_client = dialogflow.SessionsClient()
+        # noinspection PyTypeChecker
+        audio_config = self._dialogflow.InputAudioConfig(
+            audio_encoding=self._dialogflow.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
+            language_code='en',
+            sample_rate_hertz=16000,
+            single_utterance=True)
 
-        session_id = os.path.basename(path)[0]
+        def requests_generator() -> Iterator[Any]:
+            # noinspection PyTypeChecker
+            yield self._dialogflow.StreamingDetectIntentRequest(
+                session=session,
+                query_input=self._dialogflow.QueryInput(audio_config=audio_config))
+            for chunk in stream:
+                # noinspection PyTypeChecker
+                yield self._dialogflow.StreamingDetectIntentRequest(input_audio=chunk)
 
-        session = session_client.session_path(self._project_id, session_id)
+        query_result = None
+        for response in self._session_client.streaming_detect_intent(requests=requests_generator()):
+            self._mark_first_byte()
+            if response.query_result:
+                query_result = response.query_result
 
-        with open(path, 'rb') as f:
-            input_audio = f.read()
+        return None if query_result is None else self._parse_query_result(query_result)
+
+    def _cache_config(self) -> Dict[str, Any]:
+        return dict(project_id=self._project_id)
+
+    def _detect_intent(self, session_id: str, input_audio: bytes) -> Optional[Dict[str, str]]:
+        session = self._session_client.session_path(self._project_id, session_id)
 
         # noinspection PyTypeChecker
-        audio_config = dialogflow.InputAudioConfig(
-            audio_encoding=dialogflow.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
+        audio_config = self._dialogflow.InputAudioConfig(
+            audio_encoding=self._dialogflow.AudioEncoding.AUDIO_ENCODING_LINEAR_16,
             language_code='en',
             sample_rate_hertz=16000)
 
         # noinspection PyTypeChecker
-        query_input = dialogflow.QueryInput(audio_config=audio_config)
+        query_input = self._dialogflow.QueryInput(audio_config=audio_config)
 
         # noinspection PyTypeChecker
-        request = dialogflow.DetectIntentRequest(session=session, query_input=query_input, input_audio=input_audio)
+        request = self._dialogflow.DetectIntentRequest(
+            session=session,
+            query_input=query_input,
+            input_audio=input_audio)
 
-        response = session_client.detect_intent(request=request)
+        response = self._session_client.detect_intent(request=request)
+        self._mark_first_byte()
 
-        result = dict(intent=response.query_result.intent.display_name, slots=dict())
+        return self._parse_query_result(response.query_result)
 
-        if response.query_result.parameters is not None:
-            for k, v in response.query_result.parameters.items():
+    @staticmethod
+    def _parse_query_result(query_result: Any) -> Dict[str, Any]:
+        result = dict(intent=query_result.intent.display_name, slots=dict())
+
+        if query_result.parameters is not None:
+            for k, v in query_result.parameters.items():
+                # slot values such as `size` are mapped onto the labels' wording when scoring, see `SlotNormalizer`
                 if v != '':
-                    if k == 'size':
-                        if '8' in v or 'eight' in v:
-                            v = 'eight ounce'
-                        elif '12' in v or 'twelve' in v:
-                            v = 'twelve ounce'
-                        elif '16' in v or 'sixteen' in v:
-                            v = 'sixteen ounce'
-                        elif '20' in v or 'twenty' in v:
-                            v = 'twenty ounce'
                     result['slots'][k] = v
 
-        with open(cache_path, 'w') as f:
-            json.dump(result, f, indent=2)
-
         return result
 
     def __str__(self) -> str:
         return Engines.GOOGLE_DIALOGFLOW.value
 
 
-class IBMWatson(Engine):
+# engines that chain a speech-to-text service with a separate NLU service. the two stages run concurrently and are
+# joined by a bounded queue, and transcripts are cached on their own so that changing the NLU model does not require
+# transcribing the audio again.
+class PipelinedEngine(Engine):
+    _TRANSCRIPT_CONTEXT_PATHS = ()
+
+    def __init__(self, log: Optional[Logger] = None) -> None:
+        super(PipelinedEngine, self).__init__(log=log)
+
+        self._stt_workers = None
+        self._nlu_workers = None
+        self._queue_size = None
+        self._stt_rate_limiter = None
+        self._nlu_rate_limiter = None
+        self._transcript_config_digest = None
+
+    def set_pipeline(
+            self,
+            stt_workers: Optional[int] = None,
+            nlu_workers: Optional[int] = None,
+            queue_size: Optional[int] = None) -> None:
+        self._stt_workers = stt_workers
+        self._nlu_workers = nlu_workers
+        self._queue_size = queue_size
+
+    def set_stage_rate_limits(
+            self,
+            stt_requests_per_sec: Optional[float] = None,
+            nlu_requests_per_sec: Optional[float] = None,
+            burst: Optional[float] = None) -> None:
+        self._stt_rate_limiter = \
+            TokenBucket(rate=stt_requests_per_sec, capacity=burst) if stt_requests_per_sec else None
+        self._nlu_rate_limiter = \
+            TokenBucket(rate=nlu_requests_per_sec, capacity=burst) if nlu_requests_per_sec else None
+
+    def set_streaming(self, chunk_ms: Optional[int], speed: float = 1.) -> None:
+        super(PipelinedEngine, self).set_streaming(chunk_ms=chunk_ms, speed=speed)
+
+        self._transcript_config_digest = None
+
+    def _transcript_cache_config(self) -> Dict[str, Any]:
+        return dict()
+
+    def transcript_cache_key(self, pcm: NDArray[np.int16]) -> str:
+        if self._transcript_config_digest is None:
+            self._transcript_config_digest = self._digest(
+                dict(engine=str(self), stage='transcript', **self._transcript_cache_config()),
+                self._TRANSCRIPT_CONTEXT_PATHS)
+
+        return self._pcm_key(self._transcript_config_digest, pcm)
+
+    def _transcribe_file(self, path: str) -> Optional[str]:
+        raise NotImplementedError()
+
+    def _transcribe_pcm(self, pcm: NDArray[np.int16]) -> Optional[str]:
+        raise NotImplementedError()
+
+    def _transcribe_stream(self, stream: PacedStream) -> Optional[str]:
+        raise NotImplementedError()
+
+    def _understand(self, transcript: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError()
+
+    def _understand_transcript(self, transcript: Optional[str]) -> Optional[Dict[str, Any]]:
+        return None if transcript is None else self._understand(transcript)
+
+    def process_file(self, path: str) -> Optional[Dict[str, str]]:
+        return self._understand_transcript(self._transcribe_file(path))
+
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        return self._understand_transcript(self._transcribe_pcm(pcm))
+
+    def _stream_pcm(self, stream: PacedStream, name: str) -> Optional[Dict[str, str]]:
+        return self._understand_transcript(self._transcribe_stream(stream))
+
+    def num_service_calls(
+            self,
+            folder: str,
+            names: Sequence[str],
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None) -> int:
+        # a speech to text and an NLU request per utterance, except when the transcript or the inference is cached
+        if self._cache is None:
+            return 2 * len(names)
+
+        num_calls = 0
+        for x in names:
+            pcm, _ = self._load_utterance(os.path.join(folder, x), loader)
+            if self.cache_key(pcm) not in self._cache:
+                num_calls += 1 if self.transcript_cache_key(pcm) in self._cache else 2
+
+        return num_calls
+
+    def _transcribe_utterance(
+            self,
+            folder: str,
+            name: str,
+            retry_limit: int,
+            loader: Optional[Callable[[str], NDArray[np.int16]]]) -> \
+            Tuple[UtteranceResult, Optional[str], Optional[str]]:
+        result = UtteranceResult(name=name)
+
+        path = os.path.join(folder, name)
+        pcm, result.audio_sec = self._load_utterance(path, loader)
+        if self.is_streaming:
+            process = lambda: self._process_paced(self._transcribe_stream, pcm)
+        elif loader is None:
+            process = lambda: self._transcribe_file(path)
+        else:
+            process = lambda: self._transcribe_pcm(pcm)
+
+        if self._cache is None:
+            key = transcript_key = None
+        else:
+            with span('cache'):
+                key = self.cache_key(pcm)
+                if key in self._cache:
+                    result.inference = self._cache.get(key)
+                    result.is_cached = True
+                    return result, None, None
+
+                transcript_key = self.transcript_cache_key(pcm)
+                if transcript_key in self._cache:
+                    result.is_transcript_cached = True
+                    return result, self._cache.get(transcript_key)['transcript'], key
+
+        rate_limiter = self._rate_limiter if self._stt_rate_limiter is None else self._stt_rate_limiter
+        transcript, result.stt_sec = \
+            self._retry(process, result, retry_limit, rate_limiter=rate_limiter, stage='inference.stt')
+        result.ttfb_sec = self._timing.first_byte_sec
+
+        if transcript_key is not None and transcript is not None:
+            with span('cache'):
+                self._cache.put(transcript_key, name, dict(transcript=transcript))
+
+        if transcript is None:
+            result.latency_sec = result.stt_sec
+
+        return result, transcript, key
+
+    def _understand_utterance(
+            self,
+            result: UtteranceResult,
+            transcript: str,
+            key: Optional[str],
+            retry_limit: int) -> None:
+        rate_limiter = self._rate_limiter if self._nlu_rate_limiter is None else self._nlu_rate_limiter
+        result.inference, result.nlu_sec = self._retry(
+            lambda: self._understand(transcript),
+            result,
+            retry_limit,
+            rate_limiter=rate_limiter,
+            stage='inference.nlu')
+
+        # time spent waiting in the queue between the stages is not part of the latency of the engine. only the NLU of
+        # an utterance whose transcript is cached ran, which is reported as such rather than as an end-to-end latency
+        if not result.is_transcript_cached:
+            result.latency_sec = (result.stt_sec or 0.) + result.nlu_sec
+        if result.eos_latency_sec is not None:
+            result.eos_latency_sec += result.nlu_sec
+
+        if key is not None and result.inference is not None:
+            with span('cache'):
+                self._cache.put(key, result.name, result.inference)
+
+    def _process_utterances(
+            self,
+            folder: str,
+            names: Sequence[str],
+            retry_limit: int,
+            num_workers: int,
+            loader: Optional[Callable[[str], NDArray[np.int16]]],
+            on_result: Optional[Callable[[UtteranceResult], None]] = None) -> List[UtteranceResult]:
+        stt_workers = num_workers if self._stt_workers is None else self._stt_workers
+        nlu_workers = num_workers if self._nlu_workers is None else self._nlu_workers
+        queue_size = (2 * nlu_workers) if self._queue_size is None else self._queue_size
+
+        todo = queue.Queue()
+        for i, name in enumerate(names):
+            todo.put((i, name))
+        transcribed = queue.Queue(maxsize=queue_size)
+
+        results = [None] * len(names)
+        starts = [None] * len(names)
+        errors = list()
+
+        def transcribe() -> None:
+            while len(errors) == 0:
+                try:
+                    i, name = todo.get_nowait()
+                except queue.Empty:
+                    return
+
+                starts[i] = time.perf_counter()
+                try:
+                    results[i], transcript, key = \
+                        self._transcribe_utterance(folder, name, retry_limit=retry_limit, loader=loader)
+                    if transcript is None:
+                        results[i].total_sec = time.perf_counter() - starts[i]
+                        if on_result is not None:
+                            on_result(results[i])
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+                if transcript is not None:
+                    # blocks once the NLU stage falls behind, which keeps the STT stage from running ahead
+                    transcribed.put((i, transcript, key))
+
+        def understand() -> None:
+            while True:
+                x = transcribed.get()
+                if x is None:
+                    return
+
+                i, transcript, key = x
+                # keep draining after a failure so that the STT workers never block on a full queue
+                if len(errors) > 0:
+                    continue
+                try:
+                    self._understand_utterance(results[i], transcript, key, retry_limit=retry_limit)
+                    results[i].total_sec = time.perf_counter() - starts[i]
+                    if on_result is not None:
+                        on_result(results[i])
+                except Exception as e:
+                    errors.append(e)
+
+        with ThreadPoolExecutor(max_workers=stt_workers + nlu_workers) as executor:
+            nlu_futures = [executor.submit(understand) for _ in range(nlu_workers)]
+            for future in [executor.submit(transcribe) for _ in range(stt_workers)]:
+                future.result()
+            for _ in range(nlu_workers):
+                transcribed.put(None)
+            for future in nlu_futures:
+                future.result()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        return results
+
+
+@Engine.register(Engines.IBM_WATSON)
+class IBMWatson(PipelinedEngine):
+    _CACHE_EXTENSION = '.watson'
+    _CONTEXT_PATHS = ('data/watson/corpus.txt', 'data/watson/entity_types.json', 'data/watson/barista_dictionaries.zip')
+    _TRANSCRIPT_CONTEXT_PATHS = ('data/watson/corpus.txt',)
+
     def __init__(
             self,
             model_id: str,
@@ -204,9 +865,17 @@ class IBMWatson(Engine):
             stt_url: str,
             nlu_apikey: str,
             nlu_url: str,
+            max_connections: int = 10,
             log: Optional[Logger] = None) -> None:
         super(IBMWatson, self).__init__(log=log)
 
+        # only Watson talks to its REST API directly, hence the other engines run without `requests` installed
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._requests = requests
+        self._http_adapter = HTTPAdapter
+
         self._model_id = model_id
         self._stt_apikey = stt_apikey
         self._stt_url = stt_url
@@ -222,12 +891,37 @@ class IBMWatson(Engine):
         else:
             self._custom_id = custom_id
 
+        import ibm_watson
+        import ibm_watson.natural_language_understanding_v1
+        import ibm_watson.websocket
+        from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+
+        self._ibm_watson = ibm_watson
+        self._recognize_callback = _watson_recognize_callback(ibm_watson.websocket.RecognizeCallback)
+
+        # the IAM authenticators cache their tokens and refresh them only once they expire
+        self._stt_service = ibm_watson.SpeechToTextV1(authenticator=IAMAuthenticator(self._stt_apikey))
+        self._stt_service.set_service_url(self._stt_url)
+        self._stt_service.set_http_client(self._http_client(max_connections))
+
+        self._nlu_service = ibm_watson.NaturalLanguageUnderstandingV1(
+            authenticator=IAMAuthenticator(self._nlu_apikey),
+            version='2018-03-16')
+        self._nlu_service.set_service_url(self._nlu_url)
+        self._nlu_service.set_http_client(self._http_client(max_connections))
+
+    def _http_client(self, max_connections: int) -> Any:
+        session = self._requests.Session()
+        session.mount('https://', self._http_adapter(pool_connections=1, pool_maxsize=max_connections))
+
+        return session
+
     def _create_language_model(self) -> str:
         data = {"name": "barista_1", "base_model_name": "en-US_BroadbandModel",
                 "description": "STT custom model for coffee maker context"}
         uri = self._stt_url + "/v1/customizations"
-        response = requests.post(uri, auth=(self._username, self._stt_apikey), verify=False,
-                                 headers=self._headers, data=json.dumps(data).encode('utf-8'))
+        response = self._requests.post(uri, auth=(self._username, self._stt_apikey), verify=False,
+                                       headers=self._headers, data=json.dumps(data).encode('utf-8'))
 
         if response.status_code != 201:
             print(response.text)
@@ -243,8 +937,8 @@ class IBMWatson(Engine):
 
         uri = self._stt_url + "/v1/customizations/" + self._custom_id + "/corpora/" + corpus_name
         with open(corpus_path, 'rb') as f:
-            response = requests.post(uri, auth=(self._username, self._stt_apikey), verify=False,
-                                     headers=self._headers, data=f)
+            response = self._requests.post(uri, auth=(self._username, self._stt_apikey), verify=False,
+                                           headers=self._headers, data=f)
 
         if response.status_code != 201:
             print(response.text)
@@ -254,13 +948,14 @@ class IBMWatson(Engine):
         return uri
 
     def _get_corpus_status(self, uri: str) -> None:
-        response = requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
+        response = self._requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
         response_json = response.json()
         status = response_json['status']
         time_to_run = 0
         while status != 'analyzed' and time_to_run < 10000:
             time.sleep(10)
-            response = requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
+            response = self._requests.get(
+                uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
             response_json = response.json()
             status = response_json['status']
             time_to_run += 10
@@ -272,8 +967,8 @@ class IBMWatson(Engine):
 
     def _train(self) -> None:
         uri = self._stt_url + "/v1/customizations/" + self._custom_id + "/train"
-        response = requests.post(uri, auth=(self._username, self._stt_apikey),
-                                 verify=False, data=json.dumps({}).encode('utf-8'))
+        response = self._requests.post(uri, auth=(self._username, self._stt_apikey),
+                                       verify=False, data=json.dumps({}).encode('utf-8'))
 
         if response.status_code != 200:
             raise RuntimeError("Failed to start training custom model")
@@ -282,12 +977,13 @@ class IBMWatson(Engine):
 
     def _get_training_status(self) -> None:
         uri = self._stt_url + "/v1/customizations/" + self._custom_id
-        response = requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
+        response = self._requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
         status = response.json()['status']
         time_to_run = 0
         while status != 'available' and time_to_run < 10000:
             time.sleep(10)
-            response = requests.get(uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
+            response = self._requests.get(
+                uri, auth=(self._username, self._stt_apikey), verify=False, headers=self._headers)
             status = response.json()['status']
             time_to_run += 10
 
@@ -302,36 +998,56 @@ class IBMWatson(Engine):
         self._train()
         self._get_training_status()
 
-    def process_file(self, path: str) -> Optional[Dict[str, str]]:
-        cache_path = path.replace('.wav', '.watson')
+    def _transcribe_file(self, path: str) -> Optional[str]:
+        with open(path, 'rb') as audio_file:
+            return self._transcribe(audio=audio_file, content_type='audio/wav')
 
-        if os.path.exists(cache_path):
-            with open(cache_path) as f:
-                return json.load(f)
+    def _transcribe_pcm(self, pcm: NDArray[np.int16]) -> Optional[str]:
+        return self._transcribe(audio=pcm.tobytes(), content_type='audio/l16; rate=16000; channels=1')
 
-        stt_service = SpeechToTextV1(authenticator=IAMAuthenticator(self._stt_apikey))
-        stt_service.set_service_url(self._stt_url)
+    def _cache_config(self) -> Dict[str, Any]:
+        return dict(model_id=self._model_id, custom_id=self._custom_id)
 
-        with open(path, 'rb') as audio_file:
-            # noinspection PyUnresolvedReferences
-            stt_response = stt_service.recognize(
-                audio=audio_file,
-                content_type='audio/wav',
-                language_customization_id=self._custom_id
-            ).get_result()['results']
-
-        if stt_response:
-            transcript = stt_response[0]['alternatives'][0]['transcript'].lower()
-        else:
-            return None
+    def _transcript_cache_config(self) -> Dict[str, Any]:
+        return dict(custom_id=self._custom_id)
 
-        nlu_service = NaturalLanguageUnderstandingV1(authenticator=IAMAuthenticator(self._nlu_apikey),
-                                                     version='2018-03-16')
-        nlu_service.set_service_url(self._nlu_url)
+    def _transcribe_stream(self, stream: PacedStream) -> Optional[str]:
+        callback = self._recognize_callback()
 
         # noinspection PyUnresolvedReferences
-        response = nlu_service.analyze(
-            features=Features(entities=EntitiesOptions(model=self._model_id)),
+        self._stt_service.recognize_using_websocket(
+            audio=self._ibm_watson.websocket.AudioSource(stream),
+            content_type='audio/l16; rate=16000; channels=1',
+            recognize_callback=callback,
+            language_customization_id=self._custom_id)
+        self._mark_first_byte()
+
+        if callback.error is not None:
+            raise RuntimeError(callback.error)
+
+        return self._parse_transcript(callback.results)
+
+    def _transcribe(self, audio: Union[bytes, BinaryIO], content_type: str) -> Optional[str]:
+        # noinspection PyUnresolvedReferences
+        stt_response = self._stt_service.recognize(
+            audio=audio,
+            content_type=content_type,
+            language_customization_id=self._custom_id
+        ).get_result()['results']
+        self._mark_first_byte()
+
+        return self._parse_transcript(stt_response)
+
+    @staticmethod
+    def _parse_transcript(stt_response: Sequence[Dict[str, Any]]) -> Optional[str]:
+        return stt_response[0]['alternatives'][0]['transcript'].lower() if stt_response else None
+
+    def _understand(self, transcript: str) -> Dict[str, Any]:
+        nlu = self._ibm_watson.natural_language_understanding_v1
+
+        # noinspection PyUnresolvedReferences
+        response = self._nlu_service.analyze(
+            features=nlu.Features(entities=nlu.EntitiesOptions(model=self._model_id)),
             text=transcript,
             language='en'
         ).get_result()['entities']
@@ -344,18 +1060,35 @@ class IBMWatson(Engine):
             else:
                 slots[e['type']] = e['text']
 
-        result = dict(intent=intent, slots=slots, transcript=transcript)
-
-        with open(cache_path, 'w') as f:
-            json.dump(result, f, indent=2)
-
-        return result
+        return dict(intent=intent, slots=slots, transcript=transcript)
 
     def __str__(self) -> str:
         return Engines.IBM_WATSON.value
 
 
-class MicrosoftLUIS(Engine):
+def _watson_recognize_callback(base: type) -> type:
+    # the SDK only accepts subclasses of its own callback, so the class is defined once the SDK is imported
+    class _WatsonRecognizeCallback(base):
+        def __init__(self) -> None:
+            super(_WatsonRecognizeCallback, self).__init__()
+
+            self.results = list()
+            self.error = None
+
+        def on_data(self, data: Dict[str, Any]) -> None:
+            self.results.extend(x for x in data.get('results', list()) if x.get('final', True))
+
+        def on_error(self, error: Any) -> None:
+            self.error = error
+
+    return _WatsonRecognizeCallback
+
+
+@Engine.register(Engines.MICROSOFT_LUIS)
+class MicrosoftLUIS(PipelinedEngine):
+    _CACHE_EXTENSION = '.luis'
+    _CONTEXT_PATHS = ('data/luis/barista.json',)
+
     def __init__(
             self,
             prediction_key: str,
@@ -366,6 +1099,10 @@ class MicrosoftLUIS(Engine):
             log: Optional[Logger] = None) -> None:
         super(MicrosoftLUIS, self).__init__(log=log)
 
+        import azure.cognitiveservices.speech as speechsdk
+        from azure.cognitiveservices.language.luis.runtime import LUISRuntimeClient
+        from msrest.authentication import CognitiveServicesCredentials
+
         self._initial_silence_timeout_ms = 15000
         self._slot_name = 'staging'
         self._region = 'westus'
@@ -374,52 +1111,93 @@ class MicrosoftLUIS(Engine):
         self._app_id = app_id
         self._speech_key = speech_key
         self._speech_endpoint_id = speech_endpoint_id
-
-    def process_file(self, path: str) -> Optional[Dict[str, str]]:
-        cache_path = path.replace('.wav', '.luis')
-
-        if os.path.exists(cache_path):
-            with open(cache_path) as f:
-                return json.load(f)
+        self._speechsdk = speechsdk
 
         endpoint = \
             f"wss://{self._region}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices" \
             f"/v1?initialSilenceTimeoutMs={self._initial_silence_timeout_ms}"
+        self._speech_config = speechsdk.SpeechConfig(subscription=self._speech_key, endpoint=endpoint)
+        self._source_language_config = \
+            speechsdk.languageconfig.SourceLanguageConfig("en-US", self._speech_endpoint_id)
 
-        speech_config = speechsdk.SpeechConfig(subscription=self._speech_key, endpoint=endpoint)
-        source_language_config = speechsdk.languageconfig.SourceLanguageConfig("en-US", self._speech_endpoint_id)
-        audio_config = speechsdk.audio.AudioConfig(filename=path)
-
-        speech_recognizer = speechsdk.SpeechRecognizer(
-            speech_config=speech_config,
-            source_language_config=source_language_config,
+        # noinspection PyTypeChecker
+        self._luis_client = LUISRuntimeClient(
+            endpoint=self._endpoint_url,
+            credentials=CognitiveServicesCredentials(self._prediction_key))
+        self._luis_client.config.keep_alive = True
+
+    def _transcribe_file(self, path: str) -> Optional[str]:
+        return self._transcribe(audio_config=self._speechsdk.audio.AudioConfig(filename=path))
+
+    def _transcribe_pcm(self, pcm: NDArray[np.int16]) -> Optional[str]:
+        stream = self._speechsdk.audio.PushAudioInputStream(
+            stream_format=self._speechsdk.audio.AudioStreamFormat(
+                samples_per_second=16000,
+                bits_per_sample=16,
+                channels=1))
+        stream.write(pcm.tobytes())
+        stream.close()
+
+        return self._transcribe(audio_config=self._speechsdk.audio.AudioConfig(stream=stream))
+
+    def _transcribe_stream(self, stream: PacedStream) -> Optional[str]:
+        push_stream = self._speechsdk.audio.PushAudioInputStream(
+            stream_format=self._speechsdk.audio.AudioStreamFormat(
+                samples_per_second=16000,
+                bits_per_sample=16,
+                channels=1))
+
+        # recognition starts before the first chunk is pushed, so the service transcribes while audio is arriving
+        future = self._recognizer(self._speechsdk.audio.AudioConfig(stream=push_stream)).recognize_once_async()
+        for chunk in stream:
+            push_stream.write(chunk)
+        push_stream.close()
+        speech_response = future.get()
+        self._mark_first_byte()
+
+        return self._parse_transcript(speech_response)
+
+    def _cache_config(self) -> Dict[str, Any]:
+        return dict(app_id=self._app_id, slot_name=self._slot_name, speech_endpoint_id=self._speech_endpoint_id)
+
+    def _transcript_cache_config(self) -> Dict[str, Any]:
+        return dict(speech_endpoint_id=self._speech_endpoint_id)
+
+    def _recognizer(self, audio_config: Any) -> Any:
+        # a recognizer is bound to its audio input, so only the configuration is shared across utterances
+        return self._speechsdk.SpeechRecognizer(
+            speech_config=self._speech_config,
+            source_language_config=self._source_language_config,
             audio_config=audio_config)
-        speech_response = speech_recognizer.recognize_once()
 
+    def _transcribe(self, audio_config: Any) -> Optional[str]:
+        speech_response = self._recognizer(audio_config).recognize_once()
+        self._mark_first_byte()
+
+        return self._parse_transcript(speech_response)
+
+    def _parse_transcript(self, speech_response: Optional[Any]) -> Optional[str]:
         if speech_response is None:
             return None
 
-        if speech_response.reason == speechsdk.ResultReason.RecognizedSpeech:
+        if speech_response.reason == self._speechsdk.ResultReason.RecognizedSpeech:
             transcript = speech_response.text.lower()
-        elif speech_response.reason == speechsdk.ResultReason.NoMatch:
+        elif speech_response.reason == self._speechsdk.ResultReason.NoMatch:
             raise Exception(speech_response.no_match_details)
-        elif speech_response.reason == speechsdk.ResultReason.Canceled:
+        elif speech_response.reason == self._speechsdk.ResultReason.Canceled:
             cancellation_details = speech_response.cancellation_details
-            if cancellation_details.reason == speechsdk.CancellationReason.Error:
+            if cancellation_details.reason == self._speechsdk.CancellationReason.Error:
                 self._log.error("Error details: {}".format(cancellation_details.error_details))
             raise Exception(cancellation_details.reason)
         else:
             return None
 
-        if not transcript:
-            return None
+        return transcript if transcript else None
+
+    def _understand(self, transcript: str) -> Optional[Dict[str, Any]]:
         request = {"query": transcript}
 
-        # noinspection PyTypeChecker
-        client_runtime = LUISRuntimeClient(
-            endpoint=self._endpoint_url,
-            credentials=CognitiveServicesCredentials(self._prediction_key))
-        nlu_response = client_runtime.prediction.get_slot_prediction(
+        nlu_response = self._luis_client.prediction.get_slot_prediction(
             app_id=self._app_id,
             slot_name=self._slot_name,
             prediction_request=request)
@@ -432,52 +1210,517 @@ class MicrosoftLUIS(Engine):
         for k, v in nlu_response.prediction.entities.items():
             slots[k] = v[0][0].strip()
 
-        result = dict(intent=intent, slots=slots, transcript=transcript)
-
-        with open(cache_path, 'w') as f:
-            json.dump(result, f, indent=2)
-
-        return result
+        return dict(intent=intent, slots=slots, transcript=transcript)
 
     def __str__(self) -> str:
         return Engines.MICROSOFT_LUIS.value
 
 
+@Engine.register(Engines.PICOVOICE_RHINO)
 class PicovoiceRhino(Engine):
-    def __init__(self, access_key: str, log: Optional[Logger] = None) -> None:
+    def __init__(
+            self,
+            access_key: str,
+            processes: int = 1,
+            pad_final_frame: bool = False,
+            sensitivity: float = .75,
+            log: Optional[Logger] = None) -> None:
         super(PicovoiceRhino, self).__init__(log=log)
 
-        self._o = pvrhino.create(
-            access_key=access_key,
-            context_path=os.path.join(os.path.dirname(__file__), '../data/rhino/coffee_maker_linux.rhn'),
-            sensitivity=.75)
+        self._access_key = access_key
+        self._num_processes = processes
+        self._pad_final_frame = pad_final_frame
+        self._sensitivity = sensitivity
+
+        # with several processes only the pool workers run inference, so each of them holds the only instance
+        self._o = None
+        if processes <= 1:
+            import pvrhino
+
+            self._o = pvrhino.create(
+                access_key=access_key,
+                context_path=os.path.join(os.path.dirname(__file__), '../data/rhino/coffee_maker_linux.rhn'),
+                sensitivity=sensitivity)
+        self._lock = threading.Lock()
 
     def process_file(self, path: str) -> Optional[Dict[str, str]]:
-        pcm, sample_rate = soundfile.read(path, dtype='int16')
-        assert pcm.ndim == 1
+        with span('decode'):
+            pcm, sample_rate = read_pcm(path)
         assert sample_rate == self._o.sample_rate
 
+        return self.process_pcm(pcm, os.path.basename(path))
+
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            return self._process_pcm(pcm)
+
+    def _process_utterances(
+            self,
+            folder: str,
+            names: Sequence[str],
+            retry_limit: int,
+            num_workers: int,
+            loader: Optional[Callable[[str], NDArray[np.int16]]],
+            on_result: Optional[Callable[[UtteranceResult], None]] = None) -> List[UtteranceResult]:
+        if self._num_processes <= 1:
+            return super(PicovoiceRhino, self)._process_utterances(
+                folder,
+                names,
+                retry_limit=retry_limit,
+                num_workers=num_workers,
+                loader=loader,
+                on_result=on_result)
+
+        shard_size = max(1, -(-len(names) // (self._num_processes * 4)))
+        shards = [(folder, names[i:(i + shard_size)], retry_limit, loader) for i in range(0, len(names), shard_size)]
+
+        pool = multiprocessing.get_context('spawn').Pool(
+            processes=self._num_processes,
+            initializer=_init_rhino_worker,
+            initargs=(self._access_key, self._pad_final_frame, self._sensitivity))
+        results = list()
+        try:
+            for shard_results in pool.imap(_process_rhino_shard, shards):
+                for x in shard_results:
+                    if on_result is not None:
+                        on_result(x)
+                    results.append(x)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return results
+
+    def process_frames(self, frame_lists: Sequence[List[int]], name: str, audio_sec: float) -> UtteranceResult:
+        # processes audio that the caller already split into frames, so that several instances can share the work
+        result = UtteranceResult(name=name, audio_sec=audio_sec)
+        with self._lock:
+            result.inference, result.latency_sec = \
+                self._retry(lambda: self._process_frames(frame_lists), result, retry_limit=1, rate_limiter=None)
+
+        return result
+
+    def profile_pcm(self, pcm: NDArray[np.int16]) -> Tuple[Optional[Dict[str, str]], List[float]]:
+        frame_latencies = list()
+        with self._lock:
+            inference = self._process_pcm(pcm, frame_latencies=frame_latencies)
+
+        return inference, frame_latencies
+
+    def _process_pcm(
+            self,
+            pcm: NDArray[np.int16],
+            frame_latencies: Optional[List[float]] = None) -> Optional[Dict[str, str]]:
+        # `pvrhino` copies each frame into a ctypes buffer element by element, which is noticeably cheaper from a list
+        # of ints than from numpy scalars
+        frame_lists = (x.tolist() for x in frames(pcm, self._o.frame_length, pad=self._pad_final_frame))
+
+        return self._process_frames(frame_lists, frame_latencies=frame_latencies)
+
+    def _process_frames(
+            self,
+            frame_lists: Iterable[List[int]],
+            frame_latencies: Optional[List[float]] = None) -> Optional[Dict[str, str]]:
+        process = self._o.process
         is_finalized = False
-        start_index = 0
-        while start_index < (len(pcm) - self._o.frame_length) and not is_finalized:
-            end_index = start_index + self._o.frame_length
-            is_finalized = self._o.process(pcm[start_index: end_index])
-            start_index = end_index
+        num_frames = 0
+        for frame in frame_lists:
+            if frame_latencies is None:
+                is_finalized = process(frame)
+            else:
+                start_sec = time.perf_counter()
+                is_finalized = process(frame)
+                frame_latencies.append(time.perf_counter() - start_sec)
+            num_frames += 1
+            if is_finalized:
+                break
         if not is_finalized:
             return None
 
+        self._record(finalized_sec=num_frames * self._o.frame_length / self._o.sample_rate)
+
         inference = self._o.get_inference()
 
         return dict(intent=inference.intent, slots=inference.slots) if inference.is_understood else None
 
+    @property
+    def frame_length(self) -> int:
+        return self._o.frame_length
+
+    @property
+    def sample_rate(self) -> int:
+        return self._o.sample_rate
+
+    def delete(self) -> None:
+        if self._o is not None:
+            self._o.delete()
+            self._o = None
+
     def __del__(self) -> None:
-        self._o.delete()
+        self.delete()
 
     def __str__(self) -> str:
         return Engines.PICOVOICE_RHINO.value
 
 
+class RhinoSweep(object):
+    # evaluates several sensitivities in a single pass. each utterance is read, mixed and split into frames once and
+    # the same frames are fed to one Rhino instance per sensitivity, so that decoding does not grow with the number
+    # of sensitivities. with several processes, only the workers hold instances and each one works through its own
+    # utterances, while the results are scored here
+
+    def __init__(
+            self,
+            access_key: str,
+            sensitivities: Sequence[float],
+            processes: int = 1,
+            pad_final_frame: bool = False,
+            log: Optional[Logger] = None) -> None:
+        self._access_key = access_key
+        self._sensitivities = list(sensitivities)
+        self._num_processes = processes
+        self._pad_final_frame = pad_final_frame
+        self._label_index = None
+        self._slot_normalizer = None
+
+        self._engines = list()
+        if processes <= 1:
+            self._engines = [
+                PicovoiceRhino(access_key=access_key, pad_final_frame=pad_final_frame, sensitivity=x, log=log)
+                for x in self._sensitivities]
+
+    @property
+    def sensitivities(self) -> List[float]:
+        return list(self._sensitivities)
+
+    def set_scoring(self, label_index: LabelIndex, slot_normalizer: SlotNormalizer) -> None:
+        self._label_index = label_index
+        self._slot_normalizer = slot_normalizer
+
+    def _process_utterance(
+            self,
+            folder: str,
+            name: str,
+            loader: Optional[Callable[[str], NDArray[np.int16]]]) -> List[UtteranceResult]:
+        start = time.perf_counter()
+        if loader is None:
+            with span('decode'):
+                pcm, sample_rate = read_pcm(os.path.join(folder, name))
+            assert sample_rate == self._engines[0].sample_rate
+        else:
+            pcm = loader(name)
+        frame_lists = [x.tolist() for x in frames(pcm, self._engines[0].frame_length, pad=self._pad_final_frame)]
+        decode_sec = time.perf_counter() - start
+
+        # the cost of decoding is shared by all sensitivities, so it is added to the total time of each of them
+        results = list()
+        for engine in self._engines:
+            start = time.perf_counter()
+            result = engine.process_frames(frame_lists, name, audio_sec=len(pcm) / engine.sample_rate)
+            result.total_sec = decode_sec + time.perf_counter() - start
+            results.append(result)
+
+        return results
+
+    def process_utterances(
+            self,
+            folder: str,
+            names: Optional[Sequence[str]] = None,
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None) -> Dict[float, List[UtteranceResult]]:
+        names = Engine.utterance_names(folder) if names is None else names
+
+        if self._num_processes <= 1:
+            per_utterance = [self._process_utterance(folder, x, loader=loader) for x in names]
+        else:
+            shard_size = max(1, -(-len(names) // (self._num_processes * 4)))
+            shards = [(folder, names[i:(i + shard_size)], loader) for i in range(0, len(names), shard_size)]
+
+            pool = multiprocessing.get_context('spawn').Pool(
+                processes=self._num_processes,
+                initializer=_init_rhino_sweep_worker,
+                initargs=(self._access_key, self._sensitivities, self._pad_final_frame))
+            try:
+                per_utterance = [x for shard_results in pool.imap(_process_rhino_sweep_shard, shards)
+                                 for x in shard_results]
+                pool.close()
+            except BaseException:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        if self._label_index is None:
+            self._label_index, self._slot_normalizer = _default_scoring()
+
+        results = dict()
+        for i, sensitivity in enumerate(self._sensitivities):
+            results[sensitivity] = [x[i] for x in per_utterance]
+            _score_results(
+                results[sensitivity],
+                self._label_index,
+                self._slot_normalizer,
+                Engines.PICOVOICE_RHINO.value)
+
+        return results
+
+    def delete(self) -> None:
+        for x in self._engines:
+            x.delete()
+
+
+class _ReplayThrottlingException(Exception):
+    pass
+
+
+class _ReplayServiceUnavailable(Exception):
+    pass
+
+
+@Engine.register(Engines.REPLAY)
+class Replay(Engine):
+    # serves the inferences recorded from another engine and emulates its latency, errors and throttling, which
+    # exercises the harness's concurrency, retry and throughput handling offline
+
+    def __init__(
+            self,
+            source: str,
+            folders: Optional[Sequence[str]] = None,
+            results: Optional[Sequence[str]] = None,
+            latency_scale: float = 1.,
+            error_rate: float = 0.,
+            throttle_rate: float = 0.,
+            seed: int = 0,
+            noise_cache_folder: Optional[str] = None,
+            log: Optional[Logger] = None) -> None:
+        super(Replay, self).__init__(log=log)
+
+        self._source = Engines(source)
+        self._latency_scale = latency_scale
+        self._error_rate = error_rate
+        self._throttle_rate = throttle_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._misses = set()
+        self._noise_cache_folder = noise_cache_folder
+
+        # recordings are looked up by the digest of their audio rather than by name, since each utterance appears in
+        # every noise condition and mixed audio is bit-identical to the WAVs on disk
+        self._inferences = dict()
+        self._latencies_sec = list()
+        self._eos_latencies_sec = list()
+
+        if folders is None:
+            speech_folder = os.path.join(os.path.dirname(__file__), '../data/speech')
+            folders = [os.path.join(speech_folder, x) for x in sorted(os.listdir(speech_folder)) if x != 'clean']
+        for folder in folders:
+            self._load_legacy_cache(folder)
+        for path in (() if results is None else results):
+            self._load_results(path)
+
+        if self._log is not None:
+            self._log.info(
+                f'Loaded {len(self._inferences)} recorded inferences and '
+                f'{len(self._latencies_sec) + len(self._eos_latencies_sec)} latencies of `{self._source.value}`')
+
+    @staticmethod
+    def _audio_digest(pcm: NDArray[np.int16]) -> str:
+        return Engine._pcm_key(b'', pcm)
+
+    def _load_legacy_cache(self, folder: str) -> None:
+        extension = Engine._REGISTRY[self._source]._CACHE_EXTENSION
+        if extension is None or not os.path.isdir(folder):
+            return
+
+        for x in sorted(os.listdir(folder)):
+            wav_path = os.path.join(folder, x.replace(extension, '.wav'))
+            if x.endswith(extension) and os.path.exists(wav_path):
+                with open(os.path.join(folder, x)) as f:
+                    self._inferences[self._audio_digest(soundfile.read(wav_path, dtype='int16')[0])] = json.load(f)
+
+    def _load_results(self, path: str) -> None:
+        speech_folder = os.path.join(os.path.dirname(__file__), '../data/speech')
+        for x in ResultsTable.load(path).select(engine=self._source.value):
+            wav_path = os.path.join(speech_folder, f"{x['noise']}_{x['snr_db']}db", x['name'])
+            if os.path.exists(wav_path):
+                pcm = soundfile.read(wav_path, dtype='int16')[0]
+            else:
+                # a streamed run mixed its audio on the fly, which is rebuilt the same way
+                pcm = noisy_pcm(
+                    x['name'],
+                    noise=x['noise'],
+                    snr_db=x['snr_db'],
+                    seed=x.get('seed', 0),
+                    cache_folder=self._noise_cache_folder)
+            self._inferences[self._audio_digest(pcm)] = x['inference']
+
+            # cached results were never timed against the service
+            if not x['is_cached'] and x['latency_sec'] is not None:
+                if x.get('eos_latency_sec') is not None:
+                    self._eos_latencies_sec.append(x['eos_latency_sec'])
+                else:
+                    self._latencies_sec.append(x['latency_sec'])
+
+    def _respond(
+            self,
+            pcm: NDArray[np.int16],
+            name: str,
+            latencies_sec: Sequence[float]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            x = self._random.random()
+            latency_sec = self._random.choice(latencies_sec) * self._latency_scale if len(latencies_sec) > 0 else 0.
+
+        # a throttled request is rejected right away while a failed one takes as long as a successful one
+        if x < self._throttle_rate:
+            raise _ReplayThrottlingException(f'`{self._source.value}` replay throttled the request')
+
+        time.sleep(latency_sec)
+        self._mark_first_byte()
+
+        if x < self._throttle_rate + self._error_rate:
+            raise _ReplayServiceUnavailable(f'`{self._source.value}` replay failed the request')
+
+        digest = self._audio_digest(pcm)
+        if digest not in self._inferences:
+            with self._lock:
+                self._misses.add(name)
+            return None
+
+        return self._inferences[digest]
+
+    def process_file(self, path: str) -> Optional[Dict[str, Any]]:
+        with span('decode'):
+            pcm = soundfile.read(path, dtype='int16')[0]
+
+        return self._respond(pcm, os.path.basename(path), self._latencies_sec)
+
+    def process_pcm(self, pcm: NDArray[np.int16], name: str) -> Optional[Dict[str, Any]]:
+        return self._respond(pcm, name, self._latencies_sec)
+
+    def _stream_pcm(self, stream: PacedStream, name: str) -> Optional[Dict[str, Any]]:
+        # the audio arrives at its paced rate, after which only the delay from the end of audio to the intent remains
+        pcm = np.frombuffer(stream.read(), dtype=np.int16)
+
+        return self._respond(
+            pcm,
+            name,
+            self._eos_latencies_sec if len(self._eos_latencies_sec) > 0 else self._latencies_sec)
+
+    def process_utterances(
+            self,
+            folder: str,
+            retry_limit: int = 32,
+            num_workers: int = 1,
+            loader: Optional[Callable[[str], NDArray[np.int16]]] = None,
+            names: Optional[Sequence[str]] = None,
+            on_result: Optional[Callable[[UtteranceResult], None]] = None,
+            score_batch_size: int = 64) -> List[UtteranceResult]:
+        results = super(Replay, self).process_utterances(
+            folder,
+            retry_limit=retry_limit,
+            num_workers=num_workers,
+            loader=loader,
+            names=names,
+            on_result=on_result,
+            score_batch_size=score_batch_size)
+
+        # audio that was never recorded is scored as if the engine had returned no inference, which would pass off
+        # missing recordings as errors of the engine
+        with self._lock:
+            num_misses = sum(x.name in self._misses for x in results)
+            self._misses.difference_update(x.name for x in results)
+        if num_misses > 0 and self._log is not None:
+            # mixed on the fly, the audio of every condition comes from the clean folder
+            condition = 'this condition' if loader is not None else f'`{folder}`'
+            self._log.warning(
+                f'No recorded inference of `{self._source.value}` for {num_misses} of {len(results)} utterances in '
+                f'{condition}, which are scored as having no inference')
+
+        return results
+
+    @property
+    def source(self) -> str:
+        return self._source.value
+
+    def __str__(self) -> str:
+        return Engines.REPLAY.value
+
+
+_rhino_worker = None
+_rhino_error = None
+
+
+def _init_rhino_worker(access_key: str, pad_final_frame: bool, sensitivity: float) -> None:
+    global _rhino_worker, _rhino_error
+    # the parent holds no instance that would have failed first, and a pool replaces a worker whose initializer raises
+    # forever, so the error is kept for the first shard to report
+    try:
+        _rhino_worker = PicovoiceRhino(access_key=access_key, pad_final_frame=pad_final_frame, sensitivity=sensitivity)
+    except Exception as e:
+        _rhino_error = f'{type(e).__name__}: {e}'
+        return
+
+    # pool workers exit through `os._exit`, so the handle is released by a finalizer rather than `__del__`
+    Finalize(None, _release_rhino_worker, exitpriority=10)
+
+
+def _release_rhino_worker() -> None:
+    global _rhino_worker
+    if _rhino_worker is not None:
+        _rhino_worker.delete()
+        _rhino_worker = None
+
+
+_rhino_sweep_worker = None
+_rhino_sweep_error = None
+
+
+def _init_rhino_sweep_worker(access_key: str, sensitivities: Sequence[float], pad_final_frame: bool) -> None:
+    global _rhino_sweep_worker, _rhino_sweep_error
+    # the parent holds no instance that would have failed first, and a pool replaces a worker whose initializer raises
+    # forever, so the error is kept for the first shard to report
+    try:
+        _rhino_sweep_worker = RhinoSweep(
+            access_key=access_key,
+            sensitivities=sensitivities,
+            pad_final_frame=pad_final_frame)
+    except Exception as e:
+        _rhino_sweep_error = f'{type(e).__name__}: {e}'
+        return
+
+    Finalize(None, _release_rhino_sweep_worker, exitpriority=10)
+
+
+def _release_rhino_sweep_worker() -> None:
+    global _rhino_sweep_worker
+    if _rhino_sweep_worker is not None:
+        _rhino_sweep_worker.delete()
+        _rhino_sweep_worker = None
+
+
+def _process_rhino_sweep_shard(
+        shard: Tuple[str, Sequence[str], Optional[Callable[[str], NDArray[np.int16]]]]) -> List[List[UtteranceResult]]:
+    folder, names, loader = shard
+    if _rhino_sweep_worker is None:
+        raise RuntimeError(f"Failed to create `{Engines.PICOVOICE_RHINO.value}` instances: {_rhino_sweep_error}")
+
+    return [_rhino_sweep_worker._process_utterance(folder, x, loader=loader) for x in names]
+
+
+def _process_rhino_shard(
+        shard: Tuple[str, Sequence[str], int, Optional[Callable[[str], NDArray[np.int16]]]]) -> List[UtteranceResult]:
+    folder, names, retry_limit, loader = shard
+    if _rhino_worker is None:
+        raise RuntimeError(f"Failed to create `{Engines.PICOVOICE_RHINO.value}` instance: {_rhino_error}")
+
+    return [_rhino_worker._process_utterance(folder, x, retry_limit=retry_limit, loader=loader) for x in names]
+
+
 __all__ = [
     'Engines',
     'Engine',
+    'RhinoSweep',
+    'UtteranceResult',
 ]
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+from dataclasses import asdict
+from typing import *
+
+from engine import *
+
+
+def shard(names: Sequence[str], index: int, count: int) -> Sequence[str]:
+    assert 0 <= index < count
+
+    return names[((len(names) * index) // count):((len(names) * (index + 1)) // count)]
+
+
+def _read(path: str) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], int]:
+    manifest = None
+    records = list()
+    size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            # a run that dies mid-write leaves a partial last line, which is dropped and then overwritten on resume
+            if not line.endswith(b'\n'):
+                break
+            try:
+                x = json.loads(line)
+            except ValueError:
+                break
+            if 'manifest' in x:
+                manifest = x['manifest']
+            else:
+                records.append(x)
+            size += len(line)
+
+    return manifest, records, size
+
+
+def _result(record: Dict[str, Any]) -> UtteranceResult:
+    return UtteranceResult(**{k: v for k, v in record.items() if k not in ('engine', 'noise', 'snr_db')})
+
+
+class RunJournal(object):
+    def __init__(self, path: str, manifest: Dict[str, Any]) -> None:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._path = path
+        self._lock = threading.Lock()
+        self._completed = dict()
+
+        if os.path.exists(path):
+            existing, records, size = _read(path)
+            if existing is not None and existing != manifest:
+                raise ValueError(f"Journal `{path}` was written by a run with manifest `{existing}`")
+            for x in records:
+                self._completed.setdefault((x['engine'], x['noise'], x['snr_db']), dict())[x['name']] = _result(x)
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        else:
+            existing = None
+
+        self._f = open(path, 'a')
+        if existing is None:
+            self._write(dict(manifest=manifest))
+
+    def _write(self, x: Dict[str, Any]) -> None:
+        self._f.write(json.dumps(x) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def completed(self, engine: str, noise: str, snr_db: int) -> Dict[str, UtteranceResult]:
+        return dict(self._completed.get((engine, noise, snr_db), dict()))
+
+    def record(self, engine: str, noise: str, snr_db: int, result: UtteranceResult) -> None:
+        with self._lock:
+            self._write(dict(engine=engine, noise=noise, snr_db=snr_db, **asdict(result)))
+            self._completed.setdefault((engine, noise, snr_db), dict())[result.name] = result
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+
+def reconcile(paths: Sequence[str]) -> Tuple[Dict[str, Any], Dict[Tuple[str, str, int], List[UtteranceResult]]]:
+    manifest = None
+    shard_indices = set()
+    completed = dict()
+    for path in paths:
+        x, records, _ = _read(path)
+        if x is None:
+            raise ValueError(f"Journal `{path}` has no manifest")
+
+        x = dict(x)
+        shard_index = x.pop('shard_index')
+        if manifest is None:
+            manifest = x
+        elif x != manifest:
+            raise ValueError(f"Journal `{path}` belongs to a different run than `{paths[0]}`")
+        if shard_index in shard_indices:
+            raise ValueError(f"Shard {shard_index} appears in more than one journal")
+        shard_indices.add(shard_index)
+
+        for record in records:
+            completed.setdefault((record['engine'], record['noise'], record['snr_db']), dict())[record['name']] = \
+                _result(record)
+
+    missing = sorted(set(range(manifest['num_shards'])) - shard_indices)
+    if len(missing) > 0:
+        raise ValueError(f"Missing journals for shards {missing}")
+
+    return manifest, {k: sorted(v.values(), key=lambda x: x.name) for k, v in sorted(completed.items())}
+
+
+__all__ = [
+    'RunJournal',
+    'reconcile',
+    'shard',
+]
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+
+DEFAULT_LABEL_PATH = os.path.join(os.path.dirname(__file__), '../data/label/label.json')
+DEFAULT_NORMALIZATION_PATH = os.path.join(os.path.dirname(__file__), '../data/label/normalization.json')
+
+SLOT_UNUSED = -1
+SLOT_OK = 0
+SLOT_MISSING = 1
+SLOT_MISMATCH = 2
+
+
+class SlotNormalizer(object):
+    def __init__(self, rules: Optional[Mapping[str, Mapping[str, Sequence[Mapping[str, Any]]]]] = None) -> None:
+        # `rules` maps an engine name (or `*` for every engine) to per-slot rewrites. each rewrite replaces a value that
+        # contains any of the `contains` substrings with `value`, and the first matching rewrite wins
+        self._rules = dict() if rules is None else rules
+        self._memo = dict()
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'SlotNormalizer':
+        with open(DEFAULT_NORMALIZATION_PATH if path is None else path) as f:
+            return cls(json.load(f))
+
+    def normalize(self, engine: Optional[str], slot: str, value: str) -> str:
+        key = (engine, slot, value)
+        x = self._memo.get(key)
+        if x is None:
+            x = value.strip()
+            rules = list(self._rules.get(engine, dict()).get(slot, ())) + list(self._rules.get('*', dict()).get(slot, ()))
+            for rule in rules:
+                if any(y in x for y in rule['contains']):
+                    x = rule['value']
+                    break
+            self._memo[key] = x
+
+        return x
+
+
+@dataclass
+class BatchScore:
+    slots: List[str]
+    has_inference: NDArray[bool]
+    intent_match: NDArray[bool]
+    slot_status: NDArray[np.int8]
+    is_error: NDArray[bool]
+
+    def failures(self) -> List[Optional[str]]:
+        failures = np.select(
+            [
+                ~self.has_inference,
+                ~self.intent_match,
+                np.any(self.slot_status == SLOT_MISSING, axis=1),
+                np.any(self.slot_status == SLOT_MISMATCH, axis=1)
+            ],
+            ['no_inference', 'intent', 'slot_missing', 'slot_mismatch'],
+            default='')
+
+        return [x if x != '' else None for x in failures.tolist()]
+
+    def slot_errors(self, i: int) -> Dict[str, str]:
+        errors = dict()
+        for slot, status in zip(self.slots, self.slot_status[i].tolist()):
+            if status == SLOT_MISSING:
+                errors[slot] = 'missing'
+            elif status == SLOT_MISMATCH:
+                errors[slot] = 'mismatch'
+
+        return errors
+
+
+class LabelIndex(object):
+    def __init__(
+            self,
+            names: Sequence[str],
+            intents: Sequence[str],
+            intent_ids: NDArray[np.int32],
+            slots: Sequence[str],
+            values: Sequence[str],
+            value_ids: NDArray[np.int32]) -> None:
+        self._names = list(names)
+        self._rows = {x: i for i, x in enumerate(self._names)}
+        self._intents = list(intents)
+        self._intent_index = {x: i for i, x in enumerate(self._intents)}
+        self._slots = list(slots)
+        self._slot_index = {x: i for i, x in enumerate(self._slots)}
+        self._values = list(values)
+        self._value_index = {x: i for i, x in enumerate(self._values)}
+        self._intent_ids = intent_ids
+        # one row per utterance and one column per slot, holding the id of the expected value or -1 if the slot is
+        # not part of the utterance
+        self._value_ids = value_ids
+
+    @classmethod
+    def build(cls, labels: Mapping[str, Mapping[str, Any]]) -> 'LabelIndex':
+        names = sorted(labels.keys())
+        intents = sorted(set(labels[x]['intent'] for x in names))
+        slots = sorted(set(y for x in names for y in labels[x]['slots'].keys()))
+        values = sorted(set(y.strip() for x in names for y in labels[x]['slots'].values()))
+
+        intent_index = {x: i for i, x in enumerate(intents)}
+        slot_index = {x: i for i, x in enumerate(slots)}
+        value_index = {x: i for i, x in enumerate(values)}
+
+        intent_ids = np.array([intent_index[labels[x]['intent']] for x in names], dtype=np.int32)
+        value_ids = np.full((len(names), len(slots)), -1, dtype=np.int32)
+        for i, x in enumerate(names):
+            for slot, value in labels[x]['slots'].items():
+                value_ids[i, slot_index[slot]] = value_index[value.strip()]
+
+        return cls(names, intents, intent_ids, slots, values, value_ids)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_LABEL_PATH, cache_path: Optional[str] = None) -> 'LabelIndex':
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as x:
+                if str(x['digest']) == digest:
+                    return cls(
+                        x['names'].tolist(),
+                        x['intents'].tolist(),
+                        x['intent_ids'],
+                        x['slots'].tolist(),
+                        x['values'].tolist(),
+                        x['value_ids'])
+
+        index = cls.build(json.loads(data))
+        if cache_path is not None:
+            index.save(cache_path, digest=digest)
+
+        return index
+
+    def save(self, path: str, digest: str) -> None:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # written to a temporary file first so that concurrent runs never read a partially written cache
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez(
+                f,
+                digest=np.array(digest),
+                names=np.array(self._names),
+                intents=np.array(self._intents),
+                intent_ids=self._intent_ids,
+                slots=np.array(self._slots),
+                values=np.array(self._values),
+                value_ids=self._value_ids)
+        os.replace(temp_path, path)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._rows
+
+    def label(self, name: str) -> Dict[str, Any]:
+        i = self._rows[name]
+        slots = {x: self._values[y] for x, y in zip(self._slots, self._value_ids[i].tolist()) if y >= 0}
+
+        return dict(intent=self._intents[self._intent_ids[i]], slots=slots)
+
+    def stratified_order(self, names: Sequence[str], seed: int = 0) -> List[str]:
+        # utterances are grouped by their intent and the set of slots they carry. each group is shuffled and spread
+        # evenly over the order, so that every prefix holds the groups in about the same proportions as `names`
+        rng = np.random.default_rng(seed)
+
+        rows = np.array([self._rows[x] for x in names], dtype=np.int64)
+        patterns = np.concatenate([self._intent_ids[rows, np.newaxis], self._value_ids[rows] >= 0], axis=1)
+        _, strata = np.unique(patterns, axis=0, return_inverse=True)
+        strata = strata.reshape(-1)
+
+        positions = np.empty(len(names))
+        for stratum in np.unique(strata):
+            indices = rng.permutation(np.flatnonzero(strata == stratum))
+            positions[indices] = (np.arange(len(indices)) + rng.random()) / len(indices)
+
+        return [names[i] for i in np.argsort(positions, kind='stable')]
+
+    def score(
+            self,
+            names: Sequence[str],
+            inferences: Sequence[Optional[Dict[str, Any]]],
+            normalize: Optional[Callable[[str, str], str]] = None) -> BatchScore:
+        rows = np.array([self._rows[x] for x in names], dtype=np.int64)
+
+        # predictions are interned into the same ids as the labels. -1 marks a slot that was not predicted and -2 an
+        # intent or value that does not appear in any label, which can never match
+        has_inference = np.zeros(len(names), dtype=bool)
+        predicted_intent_ids = np.full(len(names), -2, dtype=np.int32)
+        predicted_value_ids = np.full((len(names), len(self._slots)), -1, dtype=np.int32)
+        for i, inference in enumerate(inferences):
+            if inference is None:
+                continue
+            has_inference[i] = True
+            predicted_intent_ids[i] = self._intent_index.get(inference['intent'], -2)
+            for slot, value in inference['slots'].items():
+                j = self._slot_index.get(slot)
+                if j is not None:
+                    value = value.strip() if normalize is None else normalize(slot, value)
+                    predicted_value_ids[i, j] = self._value_index.get(value, -2)
+
+        expected_value_ids = self._value_ids[rows]
+        is_expected = expected_value_ids >= 0
+        is_missing = is_expected & ((predicted_value_ids == -1) | ~has_inference[:, None])
+        is_mismatched = is_expected & ~is_missing & (predicted_value_ids != expected_value_ids)
+
+        slot_status = np.full(expected_value_ids.shape, SLOT_UNUSED, dtype=np.int8)
+        slot_status[is_expected] = SLOT_OK
+        slot_status[is_missing] = SLOT_MISSING
+        slot_status[is_mismatched] = SLOT_MISMATCH
+
+        intent_match = has_inference & (predicted_intent_ids == self._intent_ids[rows])
+        is_error = ~intent_match | np.any(is_missing | is_mismatched, axis=1)
+
+        return BatchScore(
+            slots=self._slots,
+            has_inference=has_inference,
+            intent_match=intent_match,
+            slot_status=slot_status,
+            is_error=is_error)
+
+
+__all__ = [
+    'BatchScore',
+    'DEFAULT_LABEL_PATH',
+    'DEFAULT_NORMALIZATION_PATH',
+    'LabelIndex',
+    'SlotNormalizer',
+]
@@ -0,0 +1,139 @@
+from statistics import NormalDist
+from typing import *
+
+import numpy as np
+
+
+def _percentiles(values: Sequence[float], prefix: str, qs: Sequence[int] = (50, 90, 99)) -> Dict[str, Optional[float]]:
+    if len(values) == 0:
+        return {f'{prefix}_p{q}': None for q in qs}
+
+    return {f'{prefix}_p{q}': float(x) for q, x in zip(qs, np.percentile(values, qs))}
+
+
+def summarize(results: Sequence[Any], elapsed_sec: Optional[float]) -> Dict[str, Any]:
+    live = [x for x in results if not x.is_cached and (x.latency_sec is not None or x.is_transcript_cached)]
+    cached = [x for x in results if x.is_cached]
+    # a result whose transcript is cached only has an NLU latency, hence it is left out of the end-to-end metrics
+    end_to_end = [x for x in live if x.latency_sec is not None]
+
+    num_utterances = len(results)
+    num_errors = sum(x.is_error for x in results)
+
+    summary = dict(
+        num_utterances=num_utterances,
+        num_errors=num_errors,
+        accuracy=(num_utterances - num_errors) / num_utterances if num_utterances > 0 else None,
+        num_live=len(live),
+        num_cached=len(cached),
+        num_retries=sum(x.num_retries for x in live),
+        num_transcripts_cached=sum(x.is_transcript_cached for x in live),
+        elapsed_sec=elapsed_sec)
+
+    summary.update(_percentiles([x.latency_sec for x in end_to_end], 'latency_sec'))
+    summary.update(_percentiles([x.ttfb_sec for x in end_to_end if x.ttfb_sec is not None], 'ttfb_sec'))
+    summary.update(_percentiles([x.total_sec for x in cached], 'cached_sec'))
+    summary.update(
+        _percentiles([x.eos_latency_sec for x in end_to_end if x.eos_latency_sec is not None], 'eos_latency_sec'))
+    summary.update(_percentiles([x.stt_sec for x in live if x.stt_sec is not None], 'stt_sec'))
+    summary.update(_percentiles([x.nlu_sec for x in live if x.nlu_sec is not None], 'nlu_sec'))
+
+    audio_sec = sum(x.audio_sec for x in end_to_end)
+    summary['real_time_factor'] = sum(x.latency_sec for x in end_to_end) / audio_sec if audio_sec > 0 else None
+    summary['throughput'] = len(live) / elapsed_sec if (len(live) > 0 and elapsed_sec) else None
+
+    return summary
+
+
+def wilson_interval(num_successes: int, num_trials: int, confidence: float = .95) -> Tuple[float, float]:
+    if num_trials == 0:
+        return 0., 1.
+
+    z = NormalDist().inv_cdf(.5 + confidence / 2)
+    p = num_successes / num_trials
+    center = (p + z ** 2 / (2 * num_trials)) / (1 + z ** 2 / num_trials)
+    half_width = z * np.sqrt(p * (1 - p) / num_trials + z ** 2 / (4 * num_trials ** 2)) / (1 + z ** 2 / num_trials)
+
+    return float(max(0., center - half_width)), float(min(1., center + half_width))
+
+
+def summarize_endpoint(results: Sequence[Any], speech_end_sec: Callable[[str], float]) -> Dict[str, Any]:
+    latencies = [x.finalized_sec - speech_end_sec(x.name) for x in results if x.finalized_sec is not None]
+
+    summary = dict(
+        num_finalized=len(latencies),
+        endpoint_sec_mean=float(np.mean(latencies)) if len(latencies) > 0 else None,
+        num_early=sum(x < 0 for x in latencies))
+    summary.update(_percentiles(latencies, 'endpoint_sec'))
+
+    return summary
+
+
+def _format(x: Optional[float], scale: float = 1., precision: int = 0) -> str:
+    return '-' if x is None else f'{x * scale:.{precision}f}'
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    return \
+        f"live {summary['num_live']} (retries {summary['num_retries']}) cached {summary['num_cached']} | " \
+        f"latency ms p50 {_format(summary['latency_sec_p50'], 1e3, 1)} " \
+        f"p90 {_format(summary['latency_sec_p90'], 1e3, 1)} " \
+        f"p99 {_format(summary['latency_sec_p99'], 1e3, 1)} | " \
+        f"ttfb ms p50 {_format(summary['ttfb_sec_p50'], 1e3, 1)} | " \
+        f"end of audio to intent ms p50 {_format(summary['eos_latency_sec_p50'], 1e3, 1)} " \
+        f"p90 {_format(summary['eos_latency_sec_p90'], 1e3, 1)} | " \
+        f"RTF {_format(summary['real_time_factor'], precision=3)} | " \
+        f"throughput {_format(summary['throughput'], precision=2)} utterances/sec"
+
+
+def format_stage_summary(summary: Dict[str, Any]) -> str:
+    return \
+        f"STT ms p50 {_format(summary['stt_sec_p50'], 1e3, 1)} " \
+        f"p90 {_format(summary['stt_sec_p90'], 1e3, 1)} " \
+        f"p99 {_format(summary['stt_sec_p99'], 1e3, 1)} | " \
+        f"NLU ms p50 {_format(summary['nlu_sec_p50'], 1e3, 1)} " \
+        f"p90 {_format(summary['nlu_sec_p90'], 1e3, 1)} " \
+        f"p99 {_format(summary['nlu_sec_p99'], 1e3, 1)} | " \
+        f"transcripts cached {summary['num_transcripts_cached']}"
+
+
+def format_table(rows: Sequence[Tuple[str, str, int, Dict[str, Any]]]) -> str:
+    header = ('engine', 'noise', 'SNR dB', 'utterances', 'errors', 'accuracy', 'p50 ms', 'p90 ms', 'RTF', 'utt/sec')
+    lines = [header]
+    for engine, noise, snr_db, summary in rows:
+        lines.append((
+            engine,
+            noise,
+            str(snr_db),
+            str(summary['num_utterances']),
+            str(summary['num_errors']),
+            _format(summary['accuracy'], precision=3),
+            _format(summary['latency_sec_p50'], 1e3, 1),
+            _format(summary['latency_sec_p90'], 1e3, 1),
+            _format(summary['real_time_factor'], precision=3),
+            _format(summary['throughput'], precision=2)))
+
+    widths = [max(len(x[i]) for x in lines) for i in range(len(header))]
+
+    return '\n'.join('  '.join(x.ljust(w) if i < 2 else x.rjust(w) for i, (x, w) in enumerate(zip(line, widths)))
+                     for line in lines)
+
+
+def format_endpoint_summary(summary: Dict[str, Any]) -> str:
+    return \
+        f"endpoint latency ms ({summary['num_finalized']} finalized, {summary['num_early']} before end of speech) " \
+        f"mean {_format(summary['endpoint_sec_mean'], 1e3, 1)} " \
+        f"p50 {_format(summary['endpoint_sec_p50'], 1e3, 1)} " \
+        f"p90 {_format(summary['endpoint_sec_p90'], 1e3, 1)} " \
+        f"p99 {_format(summary['endpoint_sec_p99'], 1e3, 1)}"
+
+
+__all__ = [
+    'format_endpoint_summary',
+    'format_stage_summary',
+    'format_summary',
+    'format_table',
+    'summarize',
+    'summarize_endpoint',
+    'wilson_interval',
+]
@@ -1,53 +1,321 @@
+import functools
+import hashlib
+import io
+import json
 import os
 import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from typing import *
 
 import numpy as np
 import soundfile
 from numpy.typing import NDArray
 
+from spans import *
+
 
 def path(x: str) -> str:
     return os.path.join(os.path.dirname(__file__), f'../{x}')
 
 
-def _max_frame_energy(pcm: NDArray[float], frame_length: int = 2048) -> float:
-    num_frames = pcm.size // frame_length
+def _frame_energies(pcm: NDArray[float], frame_length: int = 2048) -> NDArray[float]:
+    num_frames = pcm.shape[-1] // frame_length
+
+    pcm_frames = pcm[..., :(num_frames * frame_length)].reshape(pcm.shape[:-1] + (num_frames, frame_length))
+
+    return (pcm_frames ** 2).sum(axis=-1)
+
+
+def _max_frame_energies(pcms: NDArray[float], lengths: NDArray[int], frame_length: int = 2048) -> NDArray[float]:
+    frames_power = _frame_energies(pcms, frame_length=frame_length)
+    is_valid = np.arange(frames_power.shape[1])[np.newaxis, :] < (lengths // frame_length)[:, np.newaxis]
+
+    return np.where(is_valid, frames_power, 0.).max(axis=1)
+
+
+@functools.lru_cache(maxsize=None)
+def speech_end_sec(
+        name: str,
+        clean_folder: Optional[str] = None,
+        frame_length: int = 512,
+        threshold_db: float = -35.) -> float:
+    pcm, sample_rate = soundfile.read(os.path.join(clean_folder or path('data/speech/clean'), name))
+
+    frames_power = _frame_energies(pcm, frame_length=frame_length)
+    is_speech = frames_power >= (frames_power.max() * (10 ** (threshold_db / 10.)))
+
+    return (np.flatnonzero(is_speech)[-1] + 1) * frame_length / sample_rate
+
+
+def _seed(*args: Any) -> int:
+    return int.from_bytes(hashlib.sha256(':'.join(str(x) for x in args).encode('utf-8')).digest()[:8], 'little')
+
+
+def _noise_names(folder: Optional[str] = None) -> List[str]:
+    return sorted(os.path.splitext(x)[0] for x in os.listdir(folder or path('data/noise')) if x.endswith('.wav'))
+
+
+class NoiseBank(object):
+    def __init__(self, samples: NDArray[np.int16], offsets: Mapping[str, Tuple[int, int]]) -> None:
+        self._samples = samples
+        self._offsets = dict(offsets)
+
+    @classmethod
+    def open(cls, folder: Optional[str] = None, cache_folder: Optional[str] = None) -> 'NoiseBank':
+        folder = folder or path('data/noise')
+        cache_folder = cache_folder or path('data/cache')
+
+        names = _noise_names(folder)
+        offsets = dict()
+        num_samples = 0
+        for name in names:
+            info = soundfile.info(os.path.join(folder, f'{name}.wav'))
+            assert info.samplerate == 16000 and info.channels == 1
+            offsets[name] = (num_samples, info.frames)
+            num_samples += info.frames
+
+        # every noise is concatenated into a single file of 16-bit samples that all processes map read-only, so they
+        # share one copy through the page cache. the file is rebuilt whenever a noise is added or modified
+        stats = [(x, os.stat(os.path.join(folder, f'{x}.wav'))) for x in names]
+        digest = hashlib.sha256(json.dumps([(x, y.st_size, y.st_mtime_ns) for x, y in stats]).encode('utf-8'))
+        bank_path = os.path.join(cache_folder, f'noise_{digest.hexdigest()[:16]}.npy')
+        if not os.path.exists(bank_path):
+            os.makedirs(cache_folder, exist_ok=True)
+
+            # the file is written under a name of its own and then renamed, so a process building it concurrently
+            # never truncates a file that another one has mapped
+            fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=f'{os.path.basename(bank_path)}.', dir=cache_folder)
+            os.close(fd)
+            try:
+                samples = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.int16, shape=(num_samples,))
+                for name, (start, length) in offsets.items():
+                    pcm = soundfile.read(os.path.join(folder, f'{name}.wav'), dtype='int16')[0]
+                    samples[start:(start + length)] = pcm
+                samples.flush()
+                del samples
+                os.replace(temp_path, bank_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+        return cls(np.load(bank_path, mmap_mode='r'), offsets)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._offsets.keys())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._offsets
+
+    def __getitem__(self, name: str) -> NDArray[np.int16]:
+        start, length = self._offsets[name]
+
+        return self._samples[start:(start + length)]
+
+
+_noise_bank_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _open_noise_bank(cache_folder: Optional[str]) -> NoiseBank:
+    return NoiseBank.open(cache_folder=cache_folder)
+
+
+def _noise_bank(cache_folder: Optional[str] = None) -> NoiseBank:
+    # `lru_cache` does not serialize the first calls, so without the lock every thread would build the bank
+    with _noise_bank_lock:
+        return _open_noise_bank(cache_folder)
+
 
-    pcm_frames = pcm[:(num_frames * frame_length)].reshape((num_frames, frame_length))
-    frames_power = (pcm_frames ** 2).sum(axis=1)
+@dataclass(frozen=True)
+class Condition:
+    noises: Tuple[Tuple[str, float], ...]
+    rt60_sec: Optional[float] = None
+    drr_db: float = 0.
+    gain_db: float = 0.
 
-    return frames_power.max()
+    @classmethod
+    def parse(cls, spec: str) -> 'Condition':
+        # e.g. `kitchen+babble@-6,rt60=0.4,gain=9` adds babble 6 dB below kitchen noise, reverberates the speech in a
+        # synthetic room that decays by 60 dB in 0.4 seconds and amplifies the mix by 9 dB, clipping at full scale.
+        # a plain noise name such as `kitchen` mixes exactly as before
+        sources, *options = spec.split(',')
 
+        noises = list()
+        for x in sources.split('+'):
+            name, _, level_db = x.partition('@')
+            noises.append((name, float(level_db) if level_db else 0.))
 
-def _noise_scale(speech: NDArray[float], noise: NDArray[float], snr_db: float) -> NDArray[float]:
-    assert speech.shape[0] == noise.shape[0]
+        kwargs = dict()
+        keys = dict(rt60='rt60_sec', drr='drr_db', gain='gain_db')
+        for x in options:
+            k, _, v = x.partition('=')
+            if k not in keys:
+                raise ValueError(f"Unknown option `{k}` in noise condition `{spec}`")
+            kwargs[keys[k]] = float(v)
 
-    return np.sqrt(_max_frame_energy(speech) / (_max_frame_energy(noise) * (10 ** (snr_db / 10.))))
+        return cls(noises=tuple(noises), **kwargs)
 
 
-def mix(clean_folder: str, mix_folder: str, noise: str, snr_db: float) -> None:
-    noise, sample_rate = soundfile.read(path(f'data/noise/{noise}.wav'))
+@functools.lru_cache(maxsize=None)
+def synthetic_rir(rt60_sec: float, drr_db: float = 0., seed: int = 0) -> NDArray[float]:
+    # a unit direct path followed by exponentially decaying noise that is `drr_db` below it in energy
+    rng = np.random.default_rng(_seed('rir', rt60_sec, drr_db, seed))
+
+    t = np.arange(1, int(rt60_sec * 16000)) / 16000
+    tail = rng.standard_normal(len(t)) * np.exp(-3. * np.log(10.) * t / rt60_sec)
+    tail *= np.sqrt(10 ** (-drr_db / 10.) / np.sum(tail ** 2))
+
+    rir = np.concatenate([[1.], tail])
+    rir.setflags(write=False)
+
+    return rir
+
+
+def _convolve(pcms: NDArray[float], rir: NDArray[float]) -> NDArray[float]:
+    # overlap-add convolution of every row with `rir`, truncated to the original length. an FFT four times the length
+    # of `rir` keeps the overlap small, and the tail of each block only spills into the next one
+    fft_length = 1 << int(np.ceil(np.log2(4 * len(rir))))
+    block_length = fft_length - len(rir) + 1
+    num_blocks = -(-pcms.shape[-1] // block_length)
+
+    blocks = np.zeros(pcms.shape[:-1] + (num_blocks * block_length,))
+    blocks[..., :pcms.shape[-1]] = pcms
+    blocks = blocks.reshape(pcms.shape[:-1] + (num_blocks, block_length))
+
+    convolved = np.fft.irfft(np.fft.rfft(blocks, fft_length) * np.fft.rfft(rir, fft_length), fft_length)
+    pcms_out = convolved[..., :block_length].copy()
+    pcms_out[..., 1:, :(len(rir) - 1)] += convolved[..., :-1, block_length:]
+
+    return pcms_out.reshape(pcms.shape[:-1] + (num_blocks * block_length,))[..., :pcms.shape[-1]]
+
+
+def _mix(
+        clean: NDArray[float],
+        lengths: NDArray[int],
+        names: Sequence[str],
+        condition: Condition,
+        snrs_db: Sequence[float],
+        seed: int = 0,
+        cache_folder: Optional[str] = None) -> Iterator[NDArray[float]]:
+    bank = _noise_bank(cache_folder)
+
+    is_valid = np.arange(clean.shape[1])[np.newaxis, :] < lengths[:, np.newaxis]
+    if condition.rt60_sec is not None:
+        clean = _convolve(clean, synthetic_rir(condition.rt60_sec, drr_db=condition.drr_db, seed=seed)) * is_valid
+
+    noise_segments = np.zeros_like(clean)
+    for noise, level_db in condition.noises:
+        noise_pcm = bank[noise]
+        level = 10 ** (level_db / 20.)
+        for i, name in enumerate(names):
+            assert lengths[i] <= len(noise_pcm)
+            rng = np.random.default_rng(_seed(name, noise, seed))
+            noise_start_index = rng.integers(0, len(noise_pcm) - lengths[i])
+            noise_segments[i, :lengths[i]] += \
+                level * (noise_pcm[noise_start_index:(noise_start_index + lengths[i])] / 32768.)
+
+    speech_energies = _max_frame_energies(clean, lengths)
+    noise_energies = _max_frame_energies(noise_segments, lengths)
+    snr_factors = 10 ** (np.array(snrs_db, dtype=float) / 10.)
+    noise_scales = np.sqrt(speech_energies / (noise_energies * snr_factors[:, np.newaxis]))
+
+    for snr_noise_scales in noise_scales:
+        noisy = clean + snr_noise_scales[:, np.newaxis] * noise_segments
+        noisy /= 2 * np.max(np.abs(noisy), axis=1, keepdims=True)
+
+        if condition.gain_db != 0.:
+            noisy *= 10 ** (condition.gain_db / 20.)
+            np.clip(noisy, -1., 32767 / 32768, out=noisy)
+
+        yield noisy
+
+
+@functools.lru_cache(maxsize=None)
+def _load_clean(clean_path: str) -> NDArray[np.int16]:
+    # kept as 16-bit samples, which is a quarter of the memory of the float copy and converts back to it exactly
+    with span('decode'):
+        pcm, sample_rate = soundfile.read(clean_path, dtype='int16')
     assert sample_rate == 16000
+    pcm.setflags(write=False)
+
+    return pcm
+
+
+def noisy_pcm(
+        name: str,
+        noise: str,
+        snr_db: float,
+        seed: int = 0,
+        clean_folder: Optional[str] = None,
+        cache_folder: Optional[str] = None) -> NDArray[np.int16]:
+    clean_pcm = _load_clean(os.path.join(clean_folder or path('data/speech/clean'), name)) / 32768.
+
+    with span('mix'):
+        pcm, = next(_mix(
+            clean_pcm[np.newaxis],
+            np.array([len(clean_pcm)]),
+            [name],
+            Condition.parse(noise),
+            [snr_db],
+            seed=seed,
+            cache_folder=cache_folder))
+
+        # quantize through libsndfile so that the samples are identical to the ones `mix_batch` writes to disk
+        buffer = io.BytesIO()
+        soundfile.write(buffer, pcm, 16000, format='RAW', subtype='PCM_16')
+
+    return np.frombuffer(buffer.getvalue(), dtype=np.int16)
 
-    for clean_file in os.listdir(clean_folder):
-        if clean_file.endswith('.wav'):
-            clean_pcm, sample_rate = soundfile.read(os.path.join(clean_folder, clean_file))
-            assert sample_rate == 16000
-            assert len(clean_pcm) <= len(noise)
 
-            noise_start_index = np.random.randint(0, len(noise) - len(clean_pcm))
-            noise_end_index = noise_start_index + len(clean_pcm)
+def mix_batch(
+        clean_folder: str,
+        noise: str,
+        mix_folders: Mapping[float, str],
+        seed: int = 0,
+        batch_size: int = 64,
+        cache_folder: Optional[str] = None) -> None:
+    condition = Condition.parse(noise)
+    snrs_db = list(mix_folders.keys())
 
-            noise_scale = _noise_scale(clean_pcm, noise[noise_start_index:noise_end_index], snr_db)
+    clean_files = sorted(x for x in os.listdir(clean_folder) if x.endswith('.wav'))
+    for batch_start in range(0, len(clean_files), batch_size):
+        batch_files = clean_files[batch_start:(batch_start + batch_size)]
 
-            noisy_pcm = clean_pcm + noise_scale * noise[noise_start_index:noise_end_index]
-            noisy_pcm /= 2 * np.max(np.abs(noisy_pcm))
+        clean_pcms = list()
+        with span('decode'):
+            for clean_file in batch_files:
+                clean_pcm, sample_rate = soundfile.read(os.path.join(clean_folder, clean_file))
+                assert sample_rate == 16000
+                clean_pcms.append(clean_pcm)
 
-            soundfile.write(os.path.join(mix_folder, clean_file), noisy_pcm, sample_rate)
+        lengths = np.array([len(x) for x in clean_pcms])
+        clean = np.zeros((len(batch_files), lengths.max()))
+        for i, clean_pcm in enumerate(clean_pcms):
+            clean[i, :lengths[i]] = clean_pcm
 
+        noisy_pcms = _mix(clean, lengths, batch_files, condition, snrs_db, seed=seed, cache_folder=cache_folder)
+        with span('mix'):
+            for snr_db, noisy in zip(snrs_db, noisy_pcms):
+                with span('write'):
+                    for clean_file, pcm, length in zip(batch_files, noisy, lengths):
+                        soundfile.write(os.path.join(mix_folders[snr_db], clean_file), pcm[:length], sample_rate)
 
-def run(noise: str, snrs_ds: Sequence[float], overwrite: bool = False) -> None:
+
+def mix(clean_folder: str, mix_folder: str, noise: str, snr_db: float, seed: int = 0) -> None:
+    mix_batch(clean_folder, noise, {snr_db: mix_folder}, seed=seed)
+
+
+def run(
+        noise: str,
+        snrs_ds: Sequence[float],
+        overwrite: bool = False,
+        seed: int = 0,
+        cache_folder: Optional[str] = None) -> None:
+    mix_folders = dict()
     for snr_db in snrs_ds:
         snr_dir = path(f'data/speech/{noise}_{snr_db}db')
         if os.path.isdir(snr_dir):
@@ -56,10 +324,47 @@ def run(noise: str, snrs_ds: Sequence[float], overwrite: bool = False) -> None:
             else:
                 continue
         os.mkdir(snr_dir)
+        mix_folders[snr_db] = snr_dir
+
+    if len(mix_folders) > 0:
+        mix_batch(path('data/speech/clean'), noise, mix_folders, seed=seed, cache_folder=cache_folder)
+
+
+def run_all(
+        noises: Sequence[str],
+        snrs_ds: Sequence[float],
+        overwrite: bool = False,
+        seed: int = 0,
+        processes: int = 1,
+        cache_folder: Optional[str] = None) -> None:
+    # the bank is built before any worker starts, after which every worker maps the same file
+    _noise_bank(cache_folder)
+
+    run_noise = functools.partial(run, snrs_ds=snrs_ds, overwrite=overwrite, seed=seed, cache_folder=cache_folder)
+    if processes > 1 and len(noises) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            list(executor.map(run_noise, noises))
+    else:
+        for noise in noises:
+            run_noise(noise)
+
 
-        mix(path('data/speech/clean'), snr_dir, noise, snr_db)
+def check_condition(noise: str) -> None:
+    # only the names are checked, so that validating arguments does not build the noise bank
+    condition = Condition.parse(noise)
+    names = _noise_names()
+    for x, _ in condition.noises:
+        if x not in names:
+            raise ValueError(f"`{x}` is not one of the noises in `data/noise` ({', '.join(names)})")
 
 
 __all__ = [
+    'Condition',
+    'NoiseBank',
+    'check_condition',
+    'noisy_pcm',
     'run',
+    'run_all',
+    'speech_end_sec',
+    'synthetic_rir',
 ]
@@ -0,0 +1,114 @@
+import os
+import resource
+import time
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+
+from audio import *
+
+
+def peak_rss_mb() -> float:
+    # `ru_maxrss` is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def rss_mb() -> float:
+    # the current resident set size, which unlike the peak also shows what a step adds after an earlier one used more.
+    # where `/proc` is not available it falls back to the peak
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def startup_sec() -> Optional[float]:
+    # time since the process started, which includes starting the interpreter and importing every module. the start
+    # time in `/proc/self/stat` is in clock ticks since boot and follows the command, which may contain spaces
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime_sec = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return uptime_sec - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def profile_rhino(
+        engine: Any,
+        folder: str,
+        repeat: int = 1,
+        loader: Optional[Callable[[str], NDArray[np.int16]]] = None) -> Dict[str, Any]:
+    files = sorted(x for x in os.listdir(folder) if x.endswith('.wav'))
+
+    baseline_rss_mb = peak_rss_mb()
+    frame_latencies = list()
+    num_frames = 0
+    audio_sec = 0.
+    wall_sec = 0.
+    cpu_sec = 0.
+    for _ in range(repeat):
+        for x in files:
+            if loader is None:
+                pcm, sample_rate = read_pcm(os.path.join(folder, x))
+                assert sample_rate == engine.sample_rate
+            else:
+                pcm = loader(x)
+
+            start_wall_sec = time.perf_counter()
+            start_cpu_sec = time.process_time()
+            _, latencies = engine.profile_pcm(pcm)
+            cpu_sec += time.process_time() - start_cpu_sec
+            wall_sec += time.perf_counter() - start_wall_sec
+
+            frame_latencies.extend(latencies)
+            num_frames += len(latencies)
+            audio_sec += len(pcm) / engine.sample_rate
+
+    processed_audio_sec = num_frames * engine.frame_length / engine.sample_rate
+    frame_latencies = np.array(frame_latencies)
+    qs = (50, 90, 99)
+    frame_percentiles = np.percentile(frame_latencies, qs) if num_frames > 0 else [None] * len(qs)
+
+    res = dict(
+        num_utterances=len(files) * repeat,
+        num_frames=num_frames,
+        audio_sec=audio_sec,
+        processed_audio_sec=processed_audio_sec,
+        wall_sec=wall_sec,
+        cpu_sec=cpu_sec,
+        wall_sec_per_audio_sec=wall_sec / processed_audio_sec if processed_audio_sec > 0 else None,
+        cpu_sec_per_audio_sec=cpu_sec / processed_audio_sec if processed_audio_sec > 0 else None,
+        frame_sec_mean=float(frame_latencies.mean()) if num_frames > 0 else None,
+        frame_sec_max=float(frame_latencies.max()) if num_frames > 0 else None,
+        baseline_rss_mb=baseline_rss_mb,
+        peak_rss_mb=peak_rss_mb())
+    for q, x in zip(qs, frame_percentiles):
+        res[f'frame_sec_p{q}'] = None if x is None else float(x)
+
+    return res
+
+
+def format_profile(x: Dict[str, Any]) -> str:
+    if x['num_frames'] == 0:
+        return f"{x['num_utterances']} utterances | no frames processed"
+
+    return \
+        f"{x['num_utterances']} utterances {x['num_frames']} frames ({x['processed_audio_sec']:.1f} sec of audio) | " \
+        f"wall {x['wall_sec_per_audio_sec'] * 1e3:.2f} ms/sec cpu {x['cpu_sec_per_audio_sec'] * 1e3:.2f} ms/sec | " \
+        f"frame us mean {x['frame_sec_mean'] * 1e6:.1f} p50 {x['frame_sec_p50'] * 1e6:.1f} " \
+        f"p90 {x['frame_sec_p90'] * 1e6:.1f} p99 {x['frame_sec_p99'] * 1e6:.1f} max {x['frame_sec_max'] * 1e6:.1f} | " \
+        f"peak RSS {x['peak_rss_mb']:.1f} MB (baseline {x['baseline_rss_mb']:.1f} MB)"
+
+
+__all__ = [
+    'format_profile',
+    'peak_rss_mb',
+    'profile_rhino',
+    'rss_mb',
+    'startup_sec',
+]
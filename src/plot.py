@@ -1,87 +1,304 @@
 import os
+from argparse import ArgumentParser
+from typing import *
 
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+from numpy.typing import NDArray
 
-AMAZON_LEX_CAFE = np.array([0.71, 0.82, 0.84, 0.87, 0.87, 0.87, 0.87])
-AMAZON_LEX_KITCHEN = np.array([0.80, 0.84, 0.85, 0.87, 0.87, 0.87, 0.88])
-AMAZON_LEX = (AMAZON_LEX_CAFE + AMAZON_LEX_KITCHEN) / 2.
-
-GOOGLE_DIALOGFLOW_CAFE = np.array([0.63, 0.70, 0.76, 0.79, 0.82, 0.83, 0.82])
-GOOGLE_DIALOGFLOW_KITCHEN = np.array([0.70, 0.78, 0.78, 0.80, 0.81, 0.82, 0.83])
-GOOGLE_DIALOGFLOW = (GOOGLE_DIALOGFLOW_CAFE + GOOGLE_DIALOGFLOW_KITCHEN) / 2.
-
-IBM_WATSON_CAFE = np.array([0.50, 0.76, 0.88, 0.92, 0.94, 0.95, 0.96])
-IBM_WATSON_KITCHEN = np.array([0.72, 0.84, 0.89, 0.93, 0.95, 0.95, 0.96])
-IBM_WATSON = (IBM_WATSON_CAFE + IBM_WATSON_KITCHEN) / 2.
-
-MICROSOFT_LUIS_CAFE = np.array([0.83, 0.85, 0.89, 0.90, 0.91, 0.93, 0.93])
-MICROSOFT_LUIS_KITCHEN = np.array([0.86, 0.89, 0.90, 0.91, 0.92, 0.93, 0.93])
-MICROSOFT_LUIS = (MICROSOFT_LUIS_CAFE + MICROSOFT_LUIS_KITCHEN) / 2.
-
-PICOVOICE_RHINO_CAFE = np.array([0.91, 0.96, 0.98, 0.98, 0.98, 0.99, 0.99])
-PICOVOICE_RHINO_KITCHEN = np.array([0.96, 0.97, 0.98, 0.99, 0.99, 0.99, 0.99])
-PICOVOICE_RHINO = (PICOVOICE_RHINO_CAFE + PICOVOICE_RHINO_KITCHEN) / 2.
-
-SNR_dB = [6, 9, 12, 15, 18, 21, 24]
-
-
-def plot_detailed(show: bool = False):
-    plt.plot(SNR_dB, AMAZON_LEX, color='g', marker='^', label='Amazon Lex')
-    plt.plot(SNR_dB, GOOGLE_DIALOGFLOW, color='r', marker='x', label='Google Dialogflow')
-    plt.plot(SNR_dB, IBM_WATSON, color='k', marker='s', label='IBM Watson')
-    plt.plot(SNR_dB, MICROSOFT_LUIS, color='m', marker='d', label='Microsoft LUIS')
-    plt.plot(SNR_dB, PICOVOICE_RHINO, color='b', marker='o', label='Picovoice Rhino')
-    plt.xlim(6, 24)
-    plt.xlabel('SNR dB')
-    plt.ylim(0.6, 1)
-    plt.ylabel('Accuracy (Command Acceptance Probability)')
-    plt.xticks([6, 9, 12, 15, 18, 21, 24])
-    plt.legend()
-    plt.title("Accuracy of NLU Engines")
-    plt.grid()
-    if show:
-        plt.show()
-    plt.savefig(os.path.join(os.path.dirname(__file__), '../data/misc/result.svg'))
+from results import *
 
+# (label, color, marker) of each engine, in the order they appear in the charts
+ENGINE_STYLES = {
+    'GOOGLE_DIALOGFLOW': ('Google Dialogflow', 'r', 'x'),
+    'AMAZON_LEX': ('Amazon Lex', 'g', '^'),
+    'IBM_WATSON': ('IBM Watson', 'k', 's'),
+    'MICROSOFT_LUIS': ('Microsoft LUIS', 'm', 'd'),
+    'PICOVOICE_RHINO': ('Picovoice Rhino', 'b', 'o'),
+}
 
 PV_COLOR = (55 / 255, 125 / 255, 255 / 255)
 COLOR = (100 / 255, 100 / 255, 100 / 255)
 
+DEFAULT_OUTPUT_FOLDER = os.path.join(os.path.dirname(__file__), '../data/misc')
+
+
+def _engines(table: ResultsTable) -> List[str]:
+    present = set(table.column('engine').tolist())
+
+    return [x for x in ENGINE_STYLES.keys() if x in present] + sorted(present - set(ENGINE_STYLES.keys()))
+
+
+def _style(engine: str) -> Tuple[str, Optional[str], Optional[str]]:
+    return ENGINE_STYLES.get(engine, (engine, None, None))
+
+
+def bootstrap(
+        groups: Sequence[NDArray[float]],
+        statistic: Callable[..., NDArray[float]],
+        num_resamples: int = 1000,
+        confidence: float = .95,
+        rng: Optional[np.random.Generator] = None) -> Tuple[float, float, float]:
+    # each group (one noise environment) is resampled on its own and the statistic is averaged across groups, which
+    # mirrors how the point estimate weighs the environments equally
+    rng = np.random.default_rng(0) if rng is None else rng
+
+    groups = [x for x in groups if len(x) > 0]
+    if len(groups) == 0:
+        return np.nan, np.nan, np.nan
+
+    point = np.mean([statistic(x, axis=-1) for x in groups])
+    resampled = np.mean([statistic(x[rng.integers(0, len(x), (num_resamples, len(x)))], axis=-1) for x in groups], 0)
+    lower, upper = np.percentile(resampled, [50 * (1 - confidence), 50 * (1 + confidence)])
+
+    return float(point), float(lower), float(upper)
+
+
+def _by_noise(table: ResultsTable, column: str) -> List[NDArray[float]]:
+    values = table.column(column).astype(float)
+
+    return [values[x][~np.isnan(values[x])] for x in table.groups(('noise',)).values()]
+
+
+def _accuracy_groups(table: ResultsTable) -> List[NDArray[float]]:
+    return [1. - x for x in _by_noise(table, 'is_error')]
 
-def plot(show: bool = False):
+
+def _latency_groups(table: ResultsTable) -> List[NDArray[float]]:
+    return _by_noise(table.select(is_cached=False), 'latency_sec')
+
+
+def _snr_curves(
+        table: ResultsTable,
+        groups: Callable[[ResultsTable], List[NDArray[float]]],
+        statistic: Callable[..., NDArray[float]],
+        num_resamples: int) -> Dict[str, Tuple[List[int], NDArray[float]]]:
+    curves = dict()
+    for engine in _engines(table):
+        x = table.select(engine=engine)
+        snrs_db = sorted(set(x.column('snr_db').tolist()))
+        stats = [
+            bootstrap(groups(x.select(snr_db=snr_db)), statistic, num_resamples=num_resamples) for snr_db in snrs_db]
+        curves[engine] = (snrs_db, np.array(stats))
+
+    return curves
+
+
+def _throughput(table: ResultsTable) -> Optional[float]:
+    # utterances completed per second of wall-clock time within each condition, averaged across conditions
+    table = table.select(is_cached=False)
+    timestamps = table.column('timestamp')
+    values = list()
+    for indices in table.groups(('noise', 'snr_db')).values():
+        x = timestamps[indices]
+        x = x[~np.isnan(x)]
+        if len(x) > 1 and x.max() > x.min():
+            values.append((len(x) - 1) / (x.max() - x.min()))
+
+    return float(np.mean(values)) if len(values) > 0 else None
+
+
+def _save(fig: plt.Figure, path: str, show: bool) -> None:
+    if show:
+        plt.show()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def _plot_curves(
+        curves: Dict[str, Tuple[List[int], NDArray[float]]],
+        ylabel: str,
+        title: str,
+        path: str,
+        show: bool,
+        scale: float = 1.,
+        ylim: Optional[Tuple[float, float]] = None) -> None:
     fig, ax = plt.subplots()
+    for engine, (snrs_db, stats) in curves.items():
+        label, color, marker = _style(engine)
+        ax.plot(snrs_db, stats[:, 0] * scale, color=color, marker=marker, label=label)
+        ax.fill_between(snrs_db, stats[:, 1] * scale, stats[:, 2] * scale, color=color, alpha=.15, linewidth=0)
+
+    snrs_db = sorted(set(x for snrs_db, _ in curves.values() for x in snrs_db))
+    if len(snrs_db) > 1:
+        ax.set_xlim(min(snrs_db), max(snrs_db))
+    ax.set_xticks(snrs_db)
+    ax.set_xlabel('SNR dB')
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    ax.set_ylabel(ylabel)
+    ax.legend()
+    ax.set_title(title)
+    ax.grid()
+    _save(fig, path, show)
+
+
+def plot_detailed(
+        table: ResultsTable,
+        show: bool = False,
+        output_folder: str = DEFAULT_OUTPUT_FOLDER,
+        num_resamples: int = 1000) -> None:
+    _plot_curves(
+        _snr_curves(table, _accuracy_groups, np.mean, num_resamples=num_resamples),
+        ylabel='Accuracy (Command Acceptance Probability)',
+        title="Accuracy of NLU Engines",
+        path=os.path.join(output_folder, 'result.svg'),
+        show=show,
+        ylim=(0.6, 1))
 
-    for spine in plt.gca().spines.values():
+
+def plot_latency(
+        table: ResultsTable,
+        show: bool = False,
+        output_folder: str = DEFAULT_OUTPUT_FOLDER,
+        num_resamples: int = 1000) -> None:
+    curves = _snr_curves(table, _latency_groups, np.median, num_resamples=num_resamples)
+    curves = {k: v for k, v in curves.items() if not np.all(np.isnan(v[1][:, 0]))}
+    if len(curves) == 0:
+        return
+
+    _plot_curves(
+        curves,
+        ylabel='Median Latency (ms)',
+        title="Latency of NLU Engines",
+        path=os.path.join(output_folder, 'result-latency.svg'),
+        show=show,
+        scale=1e3)
+
+
+def _plot_bars(
+        ax: plt.Axes,
+        engines: Sequence[str],
+        values: Sequence[float],
+        errors: Optional[NDArray[float]] = None,
+        fmt: str = '%.1f%%') -> None:
+    for spine in ax.spines.values():
         if spine.spine_type != 'bottom':
             spine.set_visible(False)
 
-    command_acceptance_rates = [
-        GOOGLE_DIALOGFLOW.mean() * 100,
-        AMAZON_LEX.mean() * 100,
-        IBM_WATSON.mean() * 100,
-        MICROSOFT_LUIS.mean() * 100,
-        PICOVOICE_RHINO.mean() * 100
-    ]
-
-    ax.bar(np.arange(1, 5), command_acceptance_rates[:-1], 0.4, color=COLOR)
-    ax.bar([5], [command_acceptance_rates[-1]], 0.4, color=PV_COLOR)
-
-    for i in np.arange(4):
-        ax.text(i + 1 - 0.2, int(command_acceptance_rates[i]) + 2, '%.1f%%' % command_acceptance_rates[i], color=COLOR)
-    ax.text(5 - 0.2, int(command_acceptance_rates[4]) + 2, '%.1f%%' % command_acceptance_rates[4], color=PV_COLOR)
-
-    plt.xticks(
-        np.arange(1, 6),
-        ['Google\nDialogflow', 'Amazon\nLex', 'IBM\nWatson', 'Microsoft\nLUIS', 'Picovoice\nRhino'])
-    plt.tick_params(axis='y', which='both', left=False, right=False, labelleft=False)
-    plt.title("Command Acceptance Rate\n(Averaged across various noisy environments)")
-    if show:
-        plt.show()
-    plt.savefig(os.path.join(os.path.dirname(__file__), '../data/misc/result-summary.svg'))
+    colors = [PV_COLOR if x == 'PICOVOICE_RHINO' else COLOR for x in engines]
+    positions = np.arange(1, len(engines) + 1)
+    ax.bar(positions, values, 0.4, color=colors, yerr=errors, ecolor=COLOR, capsize=3)
 
+    offset = max(values) * .02
+    for i, (value, color) in enumerate(zip(values, colors)):
+        top = value if errors is None else value + errors[1][i]
+        ax.text(positions[i] - 0.2, top + offset, fmt % value, color=color)
 
-if __name__ == '__main__':
-    plot_detailed()
+    ax.set_xticks(positions)
+    ax.set_xticklabels([_style(x)[0].replace(' ', '\n', 1) for x in engines])
+    ax.tick_params(axis='y', which='both', left=False, right=False, labelleft=False)
+
+
+def plot(
+        table: ResultsTable,
+        show: bool = False,
+        output_folder: str = DEFAULT_OUTPUT_FOLDER,
+        num_resamples: int = 1000) -> None:
+    engines = _engines(table)
+    stats = np.array([
+        bootstrap(_accuracy_groups(table.select(engine=x)), np.mean, num_resamples=num_resamples) for x in engines])
+    command_acceptance_rates = stats[:, 0] * 100
+    errors = np.abs(stats[:, 1:].T * 100 - command_acceptance_rates)
 
-    plot()
+    fig, ax = plt.subplots()
+    _plot_bars(ax, engines, command_acceptance_rates, errors=errors)
+    ax.set_title("Command Acceptance Rate\n(Averaged across various noisy environments)")
+    _save(fig, os.path.join(output_folder, 'result-summary.svg'), show)
+
+
+def _sensitivities(table: ResultsTable) -> Dict[float, str]:
+    # a sensitivity sweep reports each point as an engine of its own, named `PICOVOICE_RHINO@<sensitivity>`
+    prefix = 'PICOVOICE_RHINO@'
+
+    return {float(x[len(prefix):]): x for x in sorted(_engines(table)) if x.startswith(prefix)}
+
+
+def plot_sensitivity(
+        table: ResultsTable,
+        show: bool = False,
+        output_folder: str = DEFAULT_OUTPUT_FOLDER,
+        num_resamples: int = 1000) -> None:
+    sensitivities = _sensitivities(table)
+    if len(sensitivities) < 2:
+        return
+
+    x = sorted(sensitivities.keys())
+    fig, ax = plt.subplots()
+    for snr_db in sorted(set(table.column('snr_db').tolist())):
+        stats = np.array([
+            bootstrap(
+                _accuracy_groups(table.select(engine=sensitivities[sensitivity], snr_db=snr_db)),
+                np.mean,
+                num_resamples=num_resamples)
+            for sensitivity in x])
+        if np.all(np.isnan(stats[:, 0])):
+            continue
+        line, = ax.plot(x, stats[:, 0], marker='o', label=f'{snr_db} dB')
+        ax.fill_between(x, stats[:, 1], stats[:, 2], color=line.get_color(), alpha=.15, linewidth=0)
+
+    ax.set_xticks(x)
+    ax.set_xlabel('Sensitivity')
+    ax.set_ylabel('Accuracy (Command Acceptance Probability)')
+    ax.legend(title='SNR')
+    ax.set_title("Accuracy of Picovoice Rhino across Sensitivities")
+    ax.grid()
+    _save(fig, os.path.join(output_folder, 'result-sensitivity.svg'), show)
+
+
+def plot_throughput(table: ResultsTable, show: bool = False, output_folder: str = DEFAULT_OUTPUT_FOLDER) -> None:
+    throughputs = {x: _throughput(table.select(engine=x)) for x in _engines(table)}
+    throughputs = {k: v for k, v in throughputs.items() if v is not None}
+    if len(throughputs) == 0:
+        return
+
+    fig, ax = plt.subplots()
+    _plot_bars(ax, list(throughputs.keys()), list(throughputs.values()), fmt='%.1f')
+    ax.set_title("Throughput (utterances per second)\n(Averaged across noisy environments and SNRs)")
+    _save(fig, os.path.join(output_folder, 'result-throughput.svg'), show)
+
+
+def render(
+        table: ResultsTable,
+        show: bool = False,
+        output_folder: str = DEFAULT_OUTPUT_FOLDER,
+        num_resamples: int = 1000) -> None:
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+
+    plot_detailed(table, show=show, output_folder=output_folder, num_resamples=num_resamples)
+    plot(table, show=show, output_folder=output_folder, num_resamples=num_resamples)
+    plot_latency(table, show=show, output_folder=output_folder, num_resamples=num_resamples)
+    plot_throughput(table, show=show, output_folder=output_folder)
+    plot_sensitivity(table, show=show, output_folder=output_folder, num_resamples=num_resamples)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--results', nargs='+', required=True)
+    parser.add_argument('--output_folder', default=DEFAULT_OUTPUT_FOLDER)
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--num_resamples', type=int, default=1000)
+    parser.add_argument('--show', action='store_true')
+    args = parser.parse_args()
+
+    if not args.show:
+        matplotlib.use('Agg')
+
+    # in batch mode every results file is a separate run that gets its own set of charts, all rendered in one process
+    if args.batch:
+        runs = {os.path.splitext(os.path.basename(x))[0]: [x] for x in args.results}
+    else:
+        runs = {'': args.results}
+
+    for name, paths in runs.items():
+        render(
+            ResultsTable.load(paths),
+            show=args.show,
+            output_folder=os.path.join(args.output_folder, name),
+            num_resamples=args.num_resamples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+from enum import Enum
+from typing import *
+
+
+class ErrorKinds(Enum):
+    THROTTLED = 'THROTTLED'
+    TRANSIENT = 'TRANSIENT'
+    FATAL = 'FATAL'
+
+
+_THROTTLED_NAMES = ('Throttl', 'TooManyRequests', 'ResourceExhausted', 'LimitExceeded', 'RateLimit')
+_TRANSIENT_NAMES = ('Timeout', 'Unavailable', 'Connection', 'InternalServerError', 'DeadlineExceeded')
+_FATAL_TYPES = (AssertionError, FileNotFoundError, KeyError, NotImplementedError, TypeError, ValueError)
+
+
+def _status_code(e: BaseException) -> Optional[int]:
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('ResponseMetadata', dict()).get('HTTPStatusCode')
+    else:
+        code = getattr(response, 'status_code', None)
+
+    if code is None:
+        code = getattr(e, 'status_code', getattr(e, 'code', None))
+
+    return code if isinstance(code, int) else None
+
+
+def classify_error(e: BaseException) -> ErrorKinds:
+    names = [type(e).__name__]
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        names.append(str(response.get('Error', dict()).get('Code', '')))
+
+    if any(x in name for name in names for x in _THROTTLED_NAMES):
+        return ErrorKinds.THROTTLED
+
+    code = _status_code(e)
+    if code is not None:
+        if code == 429:
+            return ErrorKinds.THROTTLED
+        if code == 408 or code >= 500:
+            return ErrorKinds.TRANSIENT
+        if 400 <= code < 500:
+            return ErrorKinds.FATAL
+
+    if isinstance(e, (TimeoutError, ConnectionError)) or any(x in name for name in names for x in _TRANSIENT_NAMES):
+        return ErrorKinds.TRANSIENT
+
+    if isinstance(e, _FATAL_TYPES):
+        return ErrorKinds.FATAL
+
+    return ErrorKinds.TRANSIENT
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        assert rate > 0
+
+        self._rate = rate
+        self._capacity = max(1., rate) if capacity is None else capacity
+        self._tokens = self._capacity
+        self._timestamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._timestamp) * self._rate)
+        self._timestamp = now
+
+    def acquire(self) -> float:
+        with self._lock:
+            self._refill()
+            self._tokens -= 1.
+            wait_sec = max(0., -self._tokens / self._rate)
+
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+        return wait_sec
+
+    def pause(self, sec: float) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.) - (sec * self._rate)
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+
+class Backoff(object):
+    def __init__(self, base_sec: float = .25, max_sec: float = 16., multiplier: float = 2.) -> None:
+        self._base_sec = base_sec
+        self._max_sec = max_sec
+        self._multiplier = multiplier
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self._max_sec, self._base_sec * (self._multiplier ** attempt)))
+
+
+__all__ = [
+    'Backoff',
+    'ErrorKinds',
+    'TokenBucket',
+    'classify_error',
+]
@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+from argparse import ArgumentParser
+from dataclasses import asdict
+from typing import *
+
+import numpy as np
+from numpy.typing import NDArray
+
+from labels import *
+
+NO_INTENT = '<none>'
+
+
+class ResultsSink(object):
+    def __init__(self, path: str, seed: int = 0) -> None:
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        self._path = path
+        self._seed = seed
+        self._lock = threading.Lock()
+        self._f = open(path, 'a')
+
+    def write(
+            self,
+            engine: str,
+            noise: str,
+            snr_db: int,
+            result: Any,
+            label: Dict[str, Any],
+            source: Optional[str] = None) -> None:
+        # `result` has already been scored, its `failure` and `slot_errors` are recorded alongside the expected label.
+        # `source` is the engine whose slot normalization rules scored it, e.g. the one a replay serves, and `seed` is
+        # the one the audio was mixed with, which together let the record be scored and its audio be rebuilt again
+        record = dict(
+            engine=engine,
+            source=source or engine,
+            noise=noise,
+            snr_db=snr_db,
+            seed=self._seed,
+            timestamp=time.time(),
+            **asdict(result))
+        record.update(
+            expected_intent=label['intent'],
+            expected_slots=label['slots'],
+            predicted_intent=None if result.inference is None else result.inference['intent'],
+            intent_match=result.failure not in ('no_inference', 'intent'))
+
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._f.close()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+
+class ResultsTable(object):
+    def __init__(self, records: Sequence[Dict[str, Any]]) -> None:
+        self._records = records
+        self._columns = dict()
+
+    @classmethod
+    def load(cls, paths: Union[str, Sequence[str]]) -> 'ResultsTable':
+        # a resumed run may write an utterance more than once, in which case its latest record wins
+        records = dict()
+        for path in ([paths] if isinstance(paths, str) else paths):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        x = json.loads(line)
+                        records[(x['engine'], x['noise'], x['snr_db'], x['name'])] = x
+
+        return cls(list(records.values()))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._records)
+
+    def column(self, name: str) -> NDArray:
+        if name not in self._columns:
+            values = [x.get(name) for x in self._records]
+            if all(isinstance(x, bool) for x in values):
+                column = np.array(values, dtype=bool)
+            elif all(isinstance(x, int) and not isinstance(x, bool) for x in values):
+                column = np.array(values, dtype=np.int64)
+            elif all(x is None or isinstance(x, (int, float)) for x in values) and any(x is not None for x in values):
+                column = np.array([np.nan if x is None else x for x in values], dtype=float)
+            else:
+                # e.g. `failure` of a run without errors, which must not become a column of NaN
+                column = np.array(values, dtype=object)
+            self._columns[name] = column
+
+        return self._columns[name]
+
+    def select(self, **conditions: Any) -> 'ResultsTable':
+        mask = np.ones(len(self), dtype=bool)
+        for k, v in conditions.items():
+            mask &= np.isin(self.column(k), v if isinstance(v, (list, tuple, set)) else [v])
+
+        return ResultsTable([self._records[i] for i in np.flatnonzero(mask)])
+
+    def rescore(self, label_index: LabelIndex, slot_normalizer: SlotNormalizer) -> 'ResultsTable':
+        # scores the stored inferences again, e.g. after the labels or the slot normalization rules changed, without
+        # calling any engine
+        records = [dict(x) for x in self._records]
+        # records written before their source was recorded are scored with the rules of the engine that wrote them
+        sources = dict()
+        for x in records:
+            sources.setdefault(x.get('source') or x['engine'], list()).append(x)
+        for source, x in sorted(sources.items()):
+            score = label_index.score(
+                [y['name'] for y in x],
+                [y['inference'] for y in x],
+                normalize=lambda slot, value: slot_normalizer.normalize(source, slot, value))
+
+            failures = score.failures()
+            for i, y in enumerate(x):
+                label = label_index.label(y['name'])
+                y.update(
+                    is_error=bool(score.is_error[i]),
+                    failure=failures[i],
+                    slot_errors=score.slot_errors(i),
+                    expected_intent=label['intent'],
+                    expected_slots=label['slots'],
+                    intent_match=bool(score.intent_match[i]))
+
+        return ResultsTable(records)
+
+    def groups(self, by: Sequence[str]) -> Dict[Tuple, NDArray[int]]:
+        keys = list(zip(*(self.column(x).tolist() for x in by)))
+        indices = dict()
+        for i, key in enumerate(keys):
+            indices.setdefault(key, list()).append(i)
+
+        return {k: np.array(v) for k, v in sorted(indices.items())}
+
+    def accuracy_table(self, by: Sequence[str] = ('engine', 'noise', 'snr_db')) -> List[Dict[str, Any]]:
+        is_error = self.column('is_error')
+        latency_sec = self.column('latency_sec')
+
+        rows = list()
+        for key, indices in self.groups(by).items():
+            num_errors = int(is_error[indices].sum())
+            latencies = latency_sec[indices]
+            latencies = latencies[~np.isnan(latencies)]
+            rows.append(dict(
+                zip(by, key),
+                num_utterances=len(indices),
+                num_errors=num_errors,
+                accuracy=1. - num_errors / len(indices),
+                latency_sec_p50=float(np.percentile(latencies, 50)) if len(latencies) > 0 else None))
+
+        return rows
+
+    def failure_counts(self) -> Dict[str, int]:
+        failures, counts = np.unique([x for x in self.column('failure') if x is not None], return_counts=True)
+
+        return {str(k): int(v) for k, v in zip(failures, counts)}
+
+    def confusion_matrix(self) -> Tuple[List[str], NDArray[np.int64]]:
+        expected = [NO_INTENT if x is None else x for x in self.column('expected_intent')]
+        predicted = [NO_INTENT if x is None else x for x in self.column('predicted_intent')]
+
+        intents = sorted(set(expected) | set(predicted))
+        index = {x: i for i, x in enumerate(intents)}
+        matrix = np.zeros((len(intents), len(intents)), dtype=np.int64)
+        np.add.at(matrix, ([index[x] for x in expected], [index[x] for x in predicted]), 1)
+
+        return intents, matrix
+
+    def slot_error_rates(self) -> Dict[str, Dict[str, Any]]:
+        # slots are only scored for utterances whose intent was understood, so that one misheard intent does not count
+        # against every slot it carries
+        rates = dict()
+        for x in self._records:
+            if not x['intent_match']:
+                continue
+            for slot in x['expected_slots'].keys():
+                counts = rates.setdefault(slot, dict(num_expected=0, num_missing=0, num_mismatched=0))
+                counts['num_expected'] += 1
+                error = x['slot_errors'].get(slot)
+                if error == 'missing':
+                    counts['num_missing'] += 1
+                elif error == 'mismatch':
+                    counts['num_mismatched'] += 1
+
+        for counts in rates.values():
+            counts['error_rate'] = (counts['num_missing'] + counts['num_mismatched']) / counts['num_expected']
+
+        return dict(sorted(rates.items()))
+
+
+def _format_rows(rows: Sequence[Sequence[str]]) -> str:
+    widths = [max(len(x[i]) for x in rows) for i in range(len(rows[0]))]
+
+    return '\n'.join('  '.join(x.rjust(w) if i > 0 else x.ljust(w) for i, (x, w) in enumerate(zip(row, widths)))
+                     for row in rows)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--results', nargs='+', required=True)
+    parser.add_argument('--engine', default=None)
+    parser.add_argument('--noise', default=None)
+    parser.add_argument('--snr_db', type=int, default=None)
+    parser.add_argument('--rescore', action='store_true')
+    parser.add_argument('--label', default=DEFAULT_LABEL_PATH)
+    parser.add_argument('--slot_normalization', default=DEFAULT_NORMALIZATION_PATH)
+    args = parser.parse_args()
+
+    table = ResultsTable.load(args.results)
+    if args.rescore:
+        table = table.rescore(LabelIndex.load(args.label), SlotNormalizer.load(args.slot_normalization))
+    conditions = dict(engine=args.engine, noise=args.noise, snr_db=args.snr_db)
+    conditions = {k: v for k, v in conditions.items() if v is not None}
+    if len(conditions) > 0:
+        table = table.select(**conditions)
+
+    rows = [('engine', 'noise', 'SNR dB', 'utterances', 'errors', 'accuracy')]
+    for x in table.accuracy_table():
+        rows.append((
+            x['engine'],
+            x['noise'],
+            str(x['snr_db']),
+            str(x['num_utterances']),
+            str(x['num_errors']),
+            f"{x['accuracy']:.3f}"))
+    print(_format_rows(rows))
+
+    failures = table.failure_counts()
+    print(f"\nfailures: {', '.join(f'{k} {v}' for k, v in failures.items()) if len(failures) > 0 else '-'}")
+
+    intents, matrix = table.confusion_matrix()
+    print('\nconfusion (rows expected, columns predicted):')
+    print(_format_rows([[''] + intents] + [[x] + [str(y) for y in row] for x, row in zip(intents, matrix)]))
+
+    rows = [('slot', 'expected', 'missing', 'mismatched', 'error rate')]
+    for slot, x in table.slot_error_rates().items():
+        rows.append((
+            slot,
+            str(x['num_expected']),
+            str(x['num_missing']),
+            str(x['num_mismatched']),
+            f"{x['error_rate']:.3f}"))
+    print()
+    print(_format_rows(rows))
+
+
+__all__ = [
+    'ResultsSink',
+    'ResultsTable',
+]
+
+if __name__ == '__main__':
+    main()
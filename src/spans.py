@@ -0,0 +1,188 @@
+import contextlib
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+from typing import *
+
+
+class _Span(object):
+    __slots__ = ('_spans', '_name', '_start_sec', '_start_cpu_sec', '_start_bytes', '_children_sec')
+
+    def __init__(self, spans: 'Spans', name: str) -> None:
+        self._spans = spans
+        self._name = name
+
+    def __enter__(self) -> '_Span':
+        self._spans._enter(self)
+        self._children_sec = 0.
+        self._start_bytes = tracemalloc.get_traced_memory()[0] if self._spans.is_tracing_allocations else None
+        self._start_cpu_sec = time.thread_time()
+        self._start_sec = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        elapsed_sec = time.perf_counter() - self._start_sec
+        cpu_sec = time.thread_time() - self._start_cpu_sec
+        alloc_bytes = None if self._start_bytes is None else tracemalloc.get_traced_memory()[0] - self._start_bytes
+        self._spans._exit(self, elapsed_sec, cpu_sec, alloc_bytes)
+
+
+class Spans(object):
+    # accumulates named timing spans around the stages of a run. spans may nest, e.g. a file read inside an inference,
+    # and the time of a span excluding its children is kept apart so that the stages add up to the time spent in them.
+    # a span must not be nested in another one of the same name, which would count its time twice. CPU time is that of
+    # the calling thread. allocations are the net change in memory traced by `tracemalloc`, which is process-wide, so
+    # with several workers they include what the other workers allocated meanwhile. only the spans of this process are
+    # collected, hence work done in worker processes shows up as the time spent waiting on them
+
+    def __init__(self, cprofile: bool = False, trace_allocations: bool = False) -> None:
+        self._stats = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = list() if cprofile else None
+        self._trace_allocations = trace_allocations
+        self._start_sec = time.perf_counter()
+
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def is_tracing_allocations(self) -> bool:
+        return self._trace_allocations
+
+    def span(self, name: str) -> _Span:
+        return _Span(self, name)
+
+    def _enter(self, x: _Span) -> None:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = list()
+
+        # `cProfile` only sees the thread it is enabled in, so each thread profiles itself while it is inside a span
+        if len(stack) == 0 and self._profiles is not None:
+            profile = getattr(self._local, 'profile', None)
+            if profile is None:
+                profile = self._local.profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.append(profile)
+            profile.enable()
+
+        stack.append(x)
+
+    def _exit(self, x: _Span, elapsed_sec: float, cpu_sec: float, alloc_bytes: Optional[int]) -> None:
+        stack = self._local.stack
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1]._children_sec += elapsed_sec
+        elif self._profiles is not None:
+            self._local.profile.disable()
+
+        with self._lock:
+            stats = self._stats.get(x._name)
+            if stats is None:
+                stats = self._stats[x._name] = dict(
+                    num_calls=0,
+                    total_sec=0.,
+                    self_sec=0.,
+                    cpu_sec=0.,
+                    max_sec=0.,
+                    net_alloc_bytes=None if alloc_bytes is None else 0)
+            stats['num_calls'] += 1
+            stats['total_sec'] += elapsed_sec
+            stats['self_sec'] += elapsed_sec - x._children_sec
+            stats['cpu_sec'] += cpu_sec
+            stats['max_sec'] = max(stats['max_sec'], elapsed_sec)
+            if alloc_bytes is not None:
+                stats['net_alloc_bytes'] += alloc_bytes
+
+    def stages(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            res = {k: dict(v) for k, v in sorted(self._stats.items(), key=lambda x: -x[1]['self_sec'])}
+        for x in res.values():
+            x['mean_sec'] = x['total_sec'] / x['num_calls']
+
+        return res
+
+    def cprofile_stats(self) -> Optional[pstats.Stats]:
+        if self._profiles is None:
+            return None
+
+        with self._lock:
+            profiles = list(self._profiles)
+        if len(profiles) == 0:
+            return None
+
+        return pstats.Stats(*profiles)
+
+    def report(self, num_top: int = 50) -> Dict[str, Any]:
+        res = dict(wall_sec=time.perf_counter() - self._start_sec, stages=self.stages())
+
+        stats = self.cprofile_stats()
+        if stats is not None:
+            functions = sorted(stats.stats.items(), key=lambda x: -x[1][3])[:num_top]
+            res['cprofile'] = [
+                dict(function=pstats.func_std_string(k), num_calls=nc, total_sec=tt, cumulative_sec=ct)
+                for k, (_, nc, tt, ct, _) in functions]
+
+        if self._trace_allocations and tracemalloc.is_tracing():
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:num_top]
+            res['tracemalloc'] = dict(
+                current_bytes=current_bytes,
+                peak_bytes=peak_bytes,
+                top=[dict(location=str(x.traceback), size_bytes=x.size, count=x.count) for x in top])
+
+        return res
+
+    def close(self) -> None:
+        if self._trace_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+_spans = None
+
+
+def enable_spans(cprofile: bool = False, trace_allocations: bool = False) -> Spans:
+    global _spans
+    _spans = Spans(cprofile=cprofile, trace_allocations=trace_allocations)
+
+    return _spans
+
+
+def disable_spans() -> None:
+    global _spans
+    if _spans is not None:
+        _spans.close()
+        _spans = None
+
+
+def span(name: str) -> ContextManager[Any]:
+    # costs a global lookup when profiling is off, so the stages are instrumented unconditionally
+    return _NO_SPAN if _spans is None else _spans.span(name)
+
+
+def format_spans(report: Dict[str, Any]) -> str:
+    lines = [f"{'stage':<20} {'calls':>8} {'self sec':>10} {'total sec':>10} {'cpu sec':>10} {'mean ms':>9} "
+             f"{'max ms':>9} {'net MB':>9}"]
+    for name, x in report['stages'].items():
+        alloc = '-' if x['net_alloc_bytes'] is None else f"{x['net_alloc_bytes'] / 2 ** 20:.1f}"
+        lines.append(
+            f"{name:<20} {x['num_calls']:>8} {x['self_sec']:>10.2f} {x['total_sec']:>10.2f} {x['cpu_sec']:>10.2f} "
+            f"{x['mean_sec'] * 1e3:>9.2f} {x['max_sec'] * 1e3:>9.2f} {alloc:>9}")
+    lines.append(f"wall {report['wall_sec']:.2f} sec")
+
+    return '\n'.join(lines)
+
+
+__all__ = [
+    'Spans',
+    'disable_spans',
+    'enable_spans',
+    'format_spans',
+    'span',
+]
@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from audio import *
+
+
+class PacedStreamTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self._pcm = np.random.default_rng(0).integers(-2 ** 15, 2 ** 15, 16000, dtype=np.int16)
+
+    def test_read_then_close(self) -> None:
+        stream = PacedStream(self._pcm, sample_rate=16000, chunk_ms=100, speed=0.)
+
+        data = list()
+        while True:
+            x = stream.read(1024)
+            if len(x) == 0:
+                break
+            self.assertLessEqual(len(x), 1024)
+            data.append(x)
+        self.assertEqual(b''.join(data), self._pcm.tobytes())
+        self.assertIsNotNone(stream.end_sec)
+
+        stream.close()
+        self.assertTrue(stream.closed)
+        self.assertEqual(stream.read(1024), b'')
+
+    def test_close_drops_pending_chunks(self) -> None:
+        stream = PacedStream(self._pcm, sample_rate=16000, chunk_ms=100, speed=0.)
+        self.assertEqual(len(stream.read(1024)), 1024)
+
+        stream.close()
+        self.assertEqual(stream.read(1024), b'')
+        self.assertEqual(stream.read(), b'')
+        self.assertEqual(list(stream), list())
+
+
+if __name__ == '__main__':
+    unittest.main()